@@ -0,0 +1,35 @@
+import time
+from test_simulated_pulse_sequence import combine_laser_pulses, combine_laser_pulses_pairwise
+
+#
+# Micro-benchmark of combine_laser_pulses, on sequences of alternating SP_729G
+# and 729G pulses (e.g. long sideband cooling or Ising sequences), compared
+# with the pairwise loop which it replaced. Run it with
+#   python ./benchmark_combine_laser_pulses.py
+# The time of the interval join should grow linearly with the number of
+# pulses, and the time of the pairwise loop quadratically.
+#
+
+def alternating_pulses(num_pulses):
+    # consecutive pulses overlap by half of their length
+    return [{"dds_name": "SP_729G" if index % 2 else "729G", "time_on": index * 1e-6, "time_off": (index + 2) * 1e-6,
+             "freq": 80e6, "amp": 1., "att": 0., "phase": 0.} for index in range(num_pulses)]
+
+def best_time(function, pulses, repeats=3):
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        function(pulses)
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+if __name__ == "__main__":
+    max_pairwise_pulses = 4000
+    for num_pulses in (1000, 2000, 4000, 8000, 16000):
+        pulses = alternating_pulses(num_pulses)
+        line = str(num_pulses) + " pulses: interval join " + "{:.1f}".format(
+            1e3 * best_time(combine_laser_pulses, pulses)) + " ms"
+        if num_pulses <= max_pairwise_pulses:
+            assert combine_laser_pulses(pulses) == combine_laser_pulses_pairwise(pulses)
+            line += ", pairwise loop " + "{:.1f}".format(1e3 * best_time(combine_laser_pulses_pairwise, pulses, 1)) + " ms"
+        print(line)
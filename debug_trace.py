@@ -0,0 +1,136 @@
+from pulse_trace import PulseTrace, pulse_columns
+import atexit
+import json
+import os
+import queue
+import threading
+import traceback
+import zlib
+
+#
+# Append-only log of the debug output of a run: the parameters of each scan,
+# and the DDS pulses and the combined laser pulses of each scan point. The
+# records are serialized, compressed and written by a background thread, so
+# that debug mode does not slow down generating the pulse sequences.
+#
+# Each record is a 4-byte little-endian header length, a JSON header
+# {"scan": ..., "point": ..., "kind": ..., "length": ...} and a zlib-compressed
+# JSON payload of the given length. The kind is "parameters" (with point
+# None), "pulses" or "laser_pulses". DebugTraceReader indexes the records by
+# their headers, and only decompresses the ones which are read.
+#
+# The writer never appends to an existing log: if the path is taken (e.g. by a
+# run which started in the same second), a number is added to the file name,
+# see path. A record which cannot be written is skipped, and close raises a
+# RuntimeError with the first error once all other records have been written.
+#
+class DebugTraceWriter:
+
+    def __init__(self, path):
+        self.file, self.path = open_new_file(path)
+        self.queue = queue.Queue()
+        self.num_failed_records = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.write_records, daemon=True)
+        self.thread.start()
+        # write the records which are still queued if the run fails
+        atexit.register(self.close)
+
+    def write_parameters(self, scan_name, parameters):
+        self.queue.put((scan_name, None, "parameters", dict(parameters)))
+
+    def write_pulses(self, scan_name, scan_idx, kind, pulses):
+        # pulses is a PulseTrace, which must not be changed afterwards
+        self.queue.put((scan_name, scan_idx, kind, pulses))
+
+    def write_records(self):
+        try:
+            while True:
+                record = self.queue.get()
+                if record is None:
+                    break
+                try:
+                    self.write_record(*record)
+                except:
+                    self.num_failed_records += 1
+                    if self.error is None:
+                        self.error = traceback.format_exc()
+        finally:
+            self.file.close()
+
+    def write_record(self, scan_name, scan_idx, kind, contents):
+        if isinstance(contents, PulseTrace):
+            contents = dict(channel_names=contents.channel_names, channels=contents.channels().tolist(),
+                **{name: column.tolist() for name, column in contents.columns().items()})
+        payload = zlib.compress(json.dumps(contents, default=str).encode("utf-8"))
+        header = json.dumps({"scan": scan_name, "point": scan_idx, "kind": kind, "length": len(payload)}).encode("utf-8")
+        self.file.write(len(header).to_bytes(4, "little") + header + payload)
+
+    def close(self):
+        # writes the queued records and closes the log, and raises if any
+        # record could not be written
+        atexit.unregister(self.close)
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Failed to write " + str(self.num_failed_records) + " of the records to " + self.path +
+                ", the first error was:\n" + error)
+
+def open_new_file(path):
+    # Opens a file which did not exist before for writing, at path or, if it
+    # exists, at path with "_2", "_3", ... added to the file name. Returns the
+    # file and its path.
+    root, extension = os.path.splitext(path)
+    number = 1
+    while True:
+        try:
+            return open(path, "xb"), path
+        except FileExistsError:
+            number += 1
+            path = root + "_" + str(number) + extension
+
+class DebugTraceReader:
+
+    def __init__(self, path):
+        self.path = path
+        self.index = dict()
+        with open(path, "rb") as trace_file:
+            while True:
+                header_length = trace_file.read(4)
+                if len(header_length) < 4:
+                    break
+                header = json.loads(trace_file.read(int.from_bytes(header_length, "little")))
+                self.index[(header["scan"], header["point"], header["kind"])] = (trace_file.tell(), header["length"])
+                trace_file.seek(header["length"], 1)
+
+    def scan_names(self):
+        return sorted(set(scan_name for scan_name, _, _ in self.index))
+
+    def points(self, scan_name):
+        return sorted(set(point for name, point, kind in self.index if name == scan_name and point is not None))
+
+    def parameters(self, scan_name):
+        return self.read(scan_name, None, "parameters")
+
+    def pulses(self, scan_name, scan_idx):
+        # the DDS pulses of a scan point, as a PulseTrace
+        return self.read_pulses(scan_name, scan_idx, "pulses")
+
+    def laser_pulses(self, scan_name, scan_idx):
+        # the combined laser pulses of a scan point, as a PulseTrace
+        return self.read_pulses(scan_name, scan_idx, "laser_pulses")
+
+    def read_pulses(self, scan_name, scan_idx, kind):
+        contents = self.read(scan_name, scan_idx, kind)
+        pulses = PulseTrace(len(contents["channels"]))
+        pulses.extend([contents["channel_names"][channel_id] for channel_id in contents["channels"]],
+            **{name: contents[name] for name in pulse_columns})
+        return pulses
+
+    def read(self, scan_name, scan_idx, kind):
+        offset, length = self.index[(scan_name, scan_idx, kind)]
+        with open(self.path, "rb") as trace_file:
+            trace_file.seek(offset)
+            return json.loads(zlib.decompress(trace_file.read(length)))
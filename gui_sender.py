@@ -0,0 +1,146 @@
+from collections import OrderedDict
+import logging
+import atexit
+import numpy as np
+import queue
+import threading
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+#
+# Sends the grapher and pulse sequence visualizer updates from a background
+# thread, so that the scan loop does not wait for the GUIs. Only the new
+# points of each plot are queued, and whenever the thread catches up it sends
+# everything which was queued in the meantime at once: one plot call (with
+# append=True) per plot with all of its new points, and only the most recent
+# pulse sequence for each visualizer.
+#
+# The grapher and visualizer are RPCConnections (see rpc_connection.py), which
+# are connected by the sender thread when they are first used. Updates for a
+# connection which is not available are dropped.
+#
+# The queue is bounded, so if a GUI falls more than max_queued_messages
+# behind, queueing blocks until the sender has caught up.
+#
+# Errors while sending are logged as warnings, and the updates which were
+# being sent are dropped. If the thread has stopped (see close), updates are
+# dropped instead of queued, and flush and close return rather than wait.
+# The updates which have been queued but not yet sent are counted in
+# num_pending, which is guarded by the condition pending.
+#
+class GuiSender:
+
+    def __init__(self, max_queued_messages=1024):
+        self.queue = queue.Queue(max_queued_messages)
+        self.pending = threading.Condition()
+        self.num_pending = 0
+        self.thread = threading.Thread(target=self.send_messages, daemon=True)
+        self.thread.start()
+        # send the remaining updates at exit, unless the GUIs are unresponsive
+        atexit.register(self.close, 10.0)
+
+    def plot(self, grapher, x_values, y_values, tab_name, plot_title, file_="", range_guess=None):
+        # appends the points (x_values, y_values) to the plot
+        self.put(("plot", grapher, plot_title, list(x_values), list(y_values),
+            dict(tab_name=tab_name, file_=file_, range_guess=range_guess)))
+
+    def plot_simulated_pulses(self, visualizer, dds, ttl, channels):
+        self.put(("plot_simulated_pulses", visualizer, (dds, ttl, channels)))
+
+    def put(self, message):
+        while self.thread.is_alive():
+            # counted before it is queued, so that it is never sent before it
+            # is counted
+            self.add_pending(1)
+            try:
+                self.queue.put(message, timeout=0.1)
+                return
+            except queue.Full:
+                self.add_pending(-1)
+
+    def add_pending(self, num_messages):
+        with self.pending:
+            self.num_pending += num_messages
+            if not self.num_pending:
+                self.pending.notify_all()
+
+    def flush(self, timeout=None):
+        # waits until all queued updates have been sent, or for at most
+        # timeout seconds, and returns whether they were sent
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.pending:
+            while self.num_pending:
+                # the thread is checked periodically, since it does not notify
+                # when it stops
+                remaining = 0.1 if deadline is None else min(0.1, deadline - time.monotonic())
+                if not self.thread.is_alive() or remaining <= 0:
+                    return False
+                self.pending.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        # sends the queued updates and stops the thread, waiting for at most
+        # timeout seconds, and returns whether all updates were sent
+        atexit.unregister(self.close)
+        sent = self.flush(timeout)
+        if sent and self.thread.is_alive():
+            try:
+                self.queue.put_nowait(None)
+                self.thread.join(timeout)
+            except queue.Full:
+                pass
+        return sent
+
+    def send_messages(self):
+        stopped = False
+        while not stopped:
+            messages = [self.queue.get()]
+            while True:
+                try:
+                    messages.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopped = None in messages
+            messages = [message for message in messages if message is not None]
+            try:
+                self.send(messages)
+            except:
+                logger.warning("Failed to send GUI updates: " + traceback.format_exc())
+            finally:
+                self.add_pending(-len(messages))
+
+    def send(self, messages):
+        plots = OrderedDict()
+        pulse_sequences = OrderedDict()
+        for message in messages:
+            if message[0] == "plot":
+                _, grapher, plot_title, x_values, y_values, kwargs = message
+                key = (id(grapher), plot_title)
+                if key in plots:
+                    plots[key][2].extend(x_values)
+                    plots[key][3].extend(y_values)
+                    plots[key][4] = kwargs
+                else:
+                    plots[key] = [grapher, plot_title, x_values, y_values, kwargs]
+            else:
+                _, visualizer, args = message
+                pulse_sequences[id(visualizer)] = (visualizer, args)
+
+        for grapher, plot_title, x_values, y_values, kwargs in plots.values():
+            self.call(grapher, "plot", np.array(x_values), np.array(y_values), plot_title=plot_title, append=True, **kwargs)
+        for visualizer, args in pulse_sequences.values():
+            self.call(visualizer, "plot_simulated_pulses", *args)
+
+    def call(self, connection, method_name, *args, **kwargs):
+        client = connection.client()
+        if client is None:
+            return
+        try:
+            getattr(client, method_name)(*args, **kwargs)
+        except OSError:
+            logger.warning("Lost connection to " + connection.target_name + ": " + traceback.format_exc())
+            connection.failed()
+        except:
+            logger.warning("Failed to call " + connection.target_name + "." + method_name + ": " + traceback.format_exc())
@@ -0,0 +1,494 @@
+from collections import OrderedDict
+from scipy.special import eval_genlaguerre
+import itertools
+import logging
+import math
+import numpy as np
+import scipy.constants
+import scipy.integrate
+import scipy.sparse
+import time
+
+logger = logging.getLogger(__name__)
+
+#
+# Simulation of the 729G pulses with exact propagators for piecewise-constant
+# Hamiltonians, as an alternative to the ODE solve in simulate.jl.
+#
+# The pulses are pure step functions, so the timeline is split at every pulse
+# edge. During a segment in which a single laser tone is on, the Hamiltonian is
+# constant in the frame rotating with that tone, so the segment is propagated
+# exactly using the eigendecomposition of the segment Hamiltonian. The
+# eigendecompositions are cached by segment Hamiltonian, so that a segment
+# which is repeated across pulses and scan points (with any duration and laser
+# phase) is only diagonalized once. Segments with several tones (e.g. the
+# bichromatic MS gate) are not constant in any frame, and are integrated
+# numerically instead.
+#
+# The physical model is the same as in simulate.jl: each ion is a Ca40 ion
+# with the S1/2 and D5/2 sublevels, the 729G beam has k = (x + z)/√2,
+# ϵ = (x - z)/√2 and B along z, there is a single axial mode (the COM mode),
+# the Lamb-Dicke expansion is kept to first order and terms rotating faster
+# than rwa_cutoff are dropped. Sublevels which are not coupled to the initial
+# state by any tone within pruning_threshold of resonance (or of a first-order
+# motional sideband) are left out of the Hilbert space, and the Fock cutoff of
+# the mode is chosen for each scan point like in simulate.jl.
+#
+# The 729G beam is a global beam and the COM mode couples to all ions equally,
+# so the ions are identical and, starting from all ions in S-1/2, the state
+# stays in the subspace which is symmetric under permutations of the ions.
+# With use_symmetric_subspace, the ions are simulated in the basis of Dicke
+# states (the number of ions in each sublevel), whose dimension grows
+# polynomially rather than exponentially with the number of ions.
+#
+
+# Names of the sublevels of each ion, in the order used by simulate.jl
+S = ["S-1/2", "S+1/2"]
+D = ["D-5/2", "D-3/2", "D-1/2", "D+1/2", "D+3/2", "D+5/2"]
+levels = S + D
+level_m = [-0.5, 0.5, -2.5, -1.5, -0.5, 0.5, 1.5, 2.5]
+level_is_D = np.array([level in D for level in levels])
+
+# Properties of Ca40 and the 729G beam, as used by IonSim
+g_factor_S = 2.0
+g_factor_D = 1.2
+wavelength = 729.147e-9
+mass = 39.962591 * scipy.constants.atomic_mass
+laser_k = np.array([1., 0., 1.]) / math.sqrt(2)
+laser_polarization = np.array([1., 0., -1.]) / math.sqrt(2)
+
+rwa_cutoff = 1e5
+pruning_threshold = rwa_cutoff
+min_fock_cutoff = 2
+max_fock_cutoff = 40
+fock_tolerance = 1e-4
+use_symmetric_subspace = True
+max_cached_models = 8
+max_cached_segments = 64
+
+# Settings which change the results, and are therefore part of the result
+# cache key (see NumpyBackend.model_fingerprint)
+model_settings = ("rwa_cutoff", "pruning_threshold", "min_fock_cutoff", "max_fock_cutoff", "fock_tolerance",
+                  "use_symmetric_subspace")
+
+global_models = OrderedDict()
+
+# Wall time in seconds spent on each scan point of the last batch: one row
+# per scan point, with the time spent on setting up the model, on the
+# propagation and on the projection, in this order, followed by the Fock cutoff
+# which was used for the point
+last_point_timings = np.zeros((0, 4))
+
+#
+# Entry points with the same contract as simulate_with_ion_sim and
+# simulate_batch_with_ion_sim in simulate.jl
+#
+def simulate_with_propagators(parameters, pulses, num_ions, b_field):
+    probabilities = simulate_batch_with_propagators(parameters, [pulses], num_ions, b_field)
+    return dict(zip(state_names(num_ions), probabilities[0]))
+
+def simulate_batch_with_propagators(parameters, pulses_per_point, num_ions, b_field):
+    global last_point_timings
+    probabilities = np.zeros((len(pulses_per_point), 2**num_ions))
+    last_point_timings = np.zeros((len(pulses_per_point), 4))
+    if not num_ions:
+        return probabilities
+    for point_index, pulses in enumerate(pulses_per_point):
+        frequencies = set(float(pulse["freq"]) for pulse in pulses if "729G" in pulse["dds_name"])
+        model, state, model_time, evolve_time = evolve_with_fock_cutoff(parameters, num_ions, b_field, frequencies, pulses)
+        start_time = time.perf_counter()
+        probabilities[point_index] = model.measure(state)
+        last_point_timings[point_index] = (model_time, evolve_time, time.perf_counter() - start_time,
+                                           model.fock_cutoff)
+        print("Scan point " + str(point_index + 1) + ": Fock cutoff " + str(model.fock_cutoff))
+    return probabilities
+
+def state_names(num_ions):
+    return ["".join(state) for state in itertools.product("SD", repeat=num_ions)]
+
+def get_model(parameters, num_ions, b_field, frequencies, fock_cutoff):
+    # Returns the cached model for this trap, number of ions, magnetic field,
+    # Fock cutoff and the sublevels addressed by the given 729G frequencies,
+    # or sets up a new one.
+    axial_frequency = float(parameters["TrapFrequencies.axial_frequency"])
+    simulated_levels = addressed_levels(frequencies, axial_frequency, b_field)
+    key = (axial_frequency, int(num_ions), float(b_field), tuple(simulated_levels), int(fock_cutoff),
+           use_symmetric_subspace)
+    if key in global_models:
+        global_models.move_to_end(key)
+        return global_models[key]
+    model = PiecewiseModel(axial_frequency, int(num_ions), float(b_field), simulated_levels, int(fock_cutoff),
+                           use_symmetric_subspace)
+    global_models[key] = model
+    while len(global_models) > max_cached_models:
+        global_models.popitem(last=False)
+    return model
+
+#
+# Choice of the Fock cutoff: the number of phonons which the pulses can create
+# is estimated from the pulses which drive a first-order motional sideband,
+# and the cutoff is doubled until the population of the top Fock state is at
+# most fock_tolerance.
+#
+def estimate_fock_cutoff(parameters, pulses, num_ions, b_field):
+    # about one phonon per sideband π-pulse, starting from the ground state
+    axial_frequency = float(parameters["TrapFrequencies.axial_frequency"])
+    eta = lamb_dicke_parameter(axial_frequency, num_ions)
+    sideband_pulse_area = 0.
+    for pulse in pulses:
+        if "729G" not in pulse["dds_name"] or pulse["time_off"] <= pulse["time_on"]:
+            continue
+        if any(drives_transition(float(pulse["freq"]), s, d, b_field, axial_frequency, (-1, 1))
+               for s in range(len(S)) for d in range(len(S), len(levels))):
+            duration = pulse["time_off"] - pulse["time_on"]
+            sideband_pulse_area += eta * pulse_rabi_frequency(pulse) * duration / np.pi
+    return int(np.clip(min_fock_cutoff + math.ceil(sideband_pulse_area), min_fock_cutoff, max_fock_cutoff))
+
+def evolve_with_fock_cutoff(parameters, num_ions, b_field, frequencies, pulses):
+    # Returns the model which was used, the final state, and the time spent
+    # on setting up the models and on evolving. Warns if the population of the
+    # top Fock state is still above fock_tolerance at max_fock_cutoff, in
+    # which case the results are affected by the truncation of the mode.
+    fock_cutoff = estimate_fock_cutoff(parameters, pulses, num_ions, b_field)
+    model_time = 0.
+    evolve_time = 0.
+    while True:
+        start_time = time.perf_counter()
+        model = get_model(parameters, num_ions, b_field, frequencies, fock_cutoff)
+        model_end_time = time.perf_counter()
+        state = model.evolve(pulses)
+        model_time += model_end_time - start_time
+        evolve_time += time.perf_counter() - model_end_time
+        top_fock_population = model.top_fock_state_population(state)
+        if top_fock_population <= fock_tolerance:
+            return model, state, model_time, evolve_time
+        if fock_cutoff >= max_fock_cutoff:
+            logger.warning("Population " + str(top_fock_population) + " in the top Fock state at the maximum Fock " +
+                           "cutoff " + str(max_fock_cutoff) + ", the results are truncated")
+            return model, state, model_time, evolve_time
+        fock_cutoff = min(2 * fock_cutoff, max_fock_cutoff)
+        print("Population " + str(top_fock_population) + " in the top Fock state, increasing the Fock cutoff to " +
+              str(fock_cutoff))
+
+#
+# Zeeman shifts of the sublevels and relative strength of the quadrupole
+# coupling between S and D sublevels
+#
+def zeeman_shifts(b_field):
+    # in Hz, for a magnetic field in gauss
+    bohr_magneton = scipy.constants.physical_constants["Bohr magneton in Hz/T"][0]
+    return bohr_magneton * b_field * 1e-4 * np.array(level_m) * np.where(level_is_D, g_factor_D, g_factor_S)
+
+def addressed_levels(frequencies, axial_frequency, b_field):
+    # Indices of the sublevels which are connected to the initial state S-1/2
+    # by transitions that one of the tones drives within pruning_threshold of
+    # resonance. D-1/2 is always kept, so that each ion has at least one S and
+    # one D sublevel.
+    def addressed(s, d):
+        return any(drives_transition(frequency, s, d, b_field, axial_frequency, (-1, 0, 1))
+                   for frequency in frequencies)
+
+    kept = {levels.index("S-1/2"), levels.index("D-1/2")}
+    changed = True
+    while changed:
+        changed = False
+        for s in range(len(S)):
+            for d in range(len(S), len(levels)):
+                if (s in kept) != (d in kept) and addressed(s, d):
+                    kept.update((s, d))
+                    changed = True
+    return sorted(kept)
+
+def drives_transition(frequency, s, d, b_field, axial_frequency, orders):
+    # Whether a tone drives the transition from sublevel s to sublevel d within
+    # pruning_threshold of resonance, on any of the given orders of motional
+    # sidebands (0 for the carrier)
+    shifts = zeeman_shifts(b_field)
+    return relative_couplings()[d, s] > 0 and any(
+        abs(frequency - (shifts[d] - shifts[s]) - order * axial_frequency) <= pruning_threshold
+        for order in orders)
+
+def clebsch_gordan_stretched(j1, m1, j2, m2):
+    # <j1 m1; j2 m2 | j1+j2 m1+m2>, which has a closed form for the
+    # stretched state J = j1 + j2
+    J = j1 + j2
+    M = m1 + m2
+    return math.sqrt(math.comb(int(2 * j1), int(j1 + m1)) * math.comb(int(2 * j2), int(j2 + m2))
+                     / math.comb(int(2 * J), int(J + M)))
+
+def quadrupole_geometry(k, polarization):
+    # Spherical components of the rank-2 tensor formed by the polarization
+    # and the wavevector, with the quantization axis along z
+    T = np.outer(polarization, k)
+    T = (T + T.T) / 2
+    return {
+        0: (2 * T[2, 2] - T[0, 0] - T[1, 1]) / math.sqrt(6),
+        1: -(T[0, 2] + 1j * T[1, 2]),
+        -1: T[0, 2] - 1j * T[1, 2],
+        2: (T[0, 0] - T[1, 1] + 2j * T[0, 1]) / 2,
+        -2: (T[0, 0] - T[1, 1] - 2j * T[0, 1]) / 2,
+    }
+
+def relative_couplings():
+    # Coupling strength of each S sublevel to each D sublevel, relative to
+    # S-1/2 -> D-1/2, which is the transition used to calibrate the pi time
+    geometry = quadrupole_geometry(laser_k, laser_polarization)
+    def coupling(m_S, m_D):
+        q = int(round(m_D - m_S))
+        if abs(q) > 2:
+            return 0.
+        return abs(geometry[q]) * clebsch_gordan_stretched(0.5, m_S, 2, q)
+    reference = coupling(-0.5, -0.5)
+    couplings = np.zeros((len(levels), len(levels)))
+    for s in range(len(S)):
+        for d in range(len(S), len(levels)):
+            couplings[d, s] = coupling(level_m[s], level_m[d]) / reference
+    return couplings
+
+def lamb_dicke_parameter(axial_frequency, num_ions):
+    # of each ion for the COM mode
+    k_z = 2 * np.pi / wavelength * laser_k[2]
+    return k_z * math.sqrt(scipy.constants.hbar / (2 * mass * num_ions * 2 * np.pi * axial_frequency))
+
+def displacement_elements(eta, fock_dimension):
+    # <n'|exp(iη(a + a†))|n> for n' = n - 1, n, n + 1, i.e. the displacement
+    # operator to first order in the Lamb-Dicke expansion
+    x = eta**2
+    n = np.arange(fock_dimension)
+    elements = {0: np.exp(-x / 2) * eval_genlaguerre(n, 0, x)}
+    raised = 1j * eta * np.exp(-x / 2) * eval_genlaguerre(n[:-1], 1, x) / np.sqrt(n[:-1] + 1)
+    elements[1] = raised
+    elements[-1] = raised
+    return elements
+
+#
+# Piecewise-constant propagation for a given trap, number of ions, magnetic
+# field, set of simulated sublevels (indices into levels) and Fock cutoff
+# (the highest phonon number of the axial mode). The basis states of the ions
+# are either all tensor products of the sublevels of each ion or, if
+# symmetric, the Dicke states. All energies are angular frequencies and all
+# times are in seconds.
+#
+class PiecewiseModel:
+
+    def __init__(self, axial_frequency, num_ions, b_field, simulated_levels, fock_cutoff, symmetric=False):
+        self.num_ions = num_ions
+        self.simulated_levels = list(simulated_levels)
+        self.is_D = level_is_D[self.simulated_levels]
+        self.fock_cutoff = fock_cutoff
+        self.symmetric = symmetric
+        fock_dimension = self.fock_dimension = fock_cutoff + 1
+        num_levels = len(self.simulated_levels)
+
+        # Number of ions in each simulated sublevel, for each basis state of
+        # the ions
+        if symmetric:
+            self.occupations = np.array([
+                np.bincount(ion_levels, minlength=num_levels)
+                for ion_levels in itertools.combinations_with_replacement(range(num_levels), num_ions)], dtype=int)
+        else:
+            ion_levels = np.array(list(itertools.product(range(num_levels), repeat=num_ions)), dtype=int)
+            self.occupations = np.zeros((len(ion_levels), num_levels), dtype=int)
+            for ion in range(num_ions):
+                self.occupations[np.arange(len(ion_levels)), ion_levels[:, ion]] += 1
+        self.dimension = len(self.occupations) * fock_dimension
+        print("Simulating sublevels " + ", ".join(levels[level] for level in self.simulated_levels) +
+              (" in the symmetric subspace" if symmetric else "") +
+              ", Hilbert space dimension " + str(self.dimension) +
+              " (instead of " + str(len(levels)**num_ions * fock_dimension) + ")")
+
+        # Energy of each basis state relative to the line center, i.e. the
+        # Zeeman shifts of the ions and the energy of the axial mode
+        zeeman = 2 * np.pi * zeeman_shifts(b_field)[self.simulated_levels]
+        nu = 2 * np.pi * axial_frequency
+        num_D = self.occupations[:, self.is_D].sum(axis=1)
+        self.energies = ((self.occupations @ zeeman)[:, None] + nu * np.arange(fock_dimension)[None, :]).ravel()
+        self.num_D = np.repeat(num_D, fock_dimension).astype(float)
+
+        # All matrix elements |D m', n'><S m, n| of the coupling for a Rabi
+        # frequency of 1, with the frequency at which each one rotates
+        couplings = relative_couplings()[np.ix_(self.simulated_levels, self.simulated_levels)]
+        displacement = displacement_elements(lamb_dicke_parameter(axial_frequency, num_ions), fock_dimension)
+        rows, cols, values = [], [], []
+        fock = np.arange(fock_dimension)
+        for s in np.flatnonzero(~self.is_D):
+            for d in np.flatnonzero(self.is_D):
+                if not couplings[d, s]:
+                    continue
+                for sources, targets, factors in self.ion_transitions(s, d):
+                    for delta_n, elements in displacement.items():
+                        n = fock[(fock + delta_n >= 0) & (fock + delta_n < fock_dimension)]
+                        rows.append((targets[:, None] * fock_dimension + n + delta_n).ravel())
+                        cols.append((sources[:, None] * fock_dimension + n).ravel())
+                        values.append((couplings[d, s] / 2 * factors[:, None] *
+                                       elements[np.minimum(n, n + delta_n)][None, :]).ravel())
+        self.rows = np.concatenate(rows)
+        self.cols = np.concatenate(cols)
+        self.values = np.concatenate(values)
+        self.transition_frequencies = self.energies[self.rows] - self.energies[self.cols]
+
+        self.segments = OrderedDict()
+
+    def ion_transitions(self, s, d):
+        #############################################
+        # Yields the basis states of the ions (as indices into occupations)
+        # which one ion going from sublevel s to sublevel d connects, with
+        # the matrix element of the collective operator relative to that of
+        # a single ion
+        if self.symmetric:
+            # |.., n_s, .., n_d, ..> -> sqrt(n_s (n_d + 1)) |.., n_s - 1, .., n_d + 1, ..>
+            index = {tuple(occupation): i for i, occupation in enumerate(self.occupations)}
+            sources = np.flatnonzero(self.occupations[:, s] > 0)
+            if not len(sources):
+                return
+            target_occupations = self.occupations[sources].copy()
+            target_occupations[:, s] -= 1
+            target_occupations[:, d] += 1
+            targets = np.array([index[tuple(occupation)] for occupation in target_occupations])
+            yield sources, targets, np.sqrt(self.occupations[sources, s] * target_occupations[:, d])
+        else:
+            # one transition per ion, the first ion being the most significant
+            num_levels = len(self.simulated_levels)
+            states = np.arange(len(self.occupations))
+            for ion in range(self.num_ions):
+                stride = num_levels**(self.num_ions - 1 - ion)
+                sources = states[(states // stride) % num_levels == s]
+                yield sources, sources + (d - s) * stride, np.ones(len(sources))
+
+    def simulate(self, pulses):
+        state = self.evolve(pulses)
+        return self.measure(state)
+
+    def evolve(self, pulses):
+        #############################################
+        # Collect the 729G pulses which are on for a finite time
+        pulses = [pulse for pulse in pulses if "729G" in pulse["dds_name"] and pulse["time_off"] > pulse["time_on"]]
+        edges = sorted(set([pulse["time_on"] for pulse in pulses] + [pulse["time_off"] for pulse in pulses]))
+
+        state = np.zeros(self.dimension, dtype=complex)
+        state[0] = 1.
+        for t_begin, t_end in zip(edges[:-1], edges[1:]):
+            #############################################
+            # Combine the pulses which are on during this segment into tones,
+            # adding up the Rabi frequencies of overlapping pulses on the same
+            # tone like simulate.jl does
+            tones = OrderedDict()
+            for pulse in pulses:
+                if pulse["time_on"] < t_end and pulse["time_off"] > t_begin:
+                    detuning = 2 * np.pi * float(pulse["freq"])
+                    rabi_frequency, phase = tones.get(detuning, (0., 2 * np.pi * float(pulse["phase"])))
+                    tones[detuning] = (rabi_frequency + pulse_rabi_frequency(pulse), phase)
+
+            if not tones:
+                state = np.exp(-1j * self.energies * (t_end - t_begin)) * state
+            elif len(tones) == 1:
+                (detuning, (rabi_frequency, phase)), = tones.items()
+                state = self.propagate_single_tone(state, detuning, rabi_frequency, phase, t_begin, t_end)
+            else:
+                state = self.propagate_multiple_tones(state, tones, t_begin, t_end)
+        return state
+
+    def propagate_single_tone(self, state, detuning, rabi_frequency, phase, t_begin, t_end):
+        # In the frame rotating with the tone, and with the laser phase
+        # factored out, the segment Hamiltonian only depends on the detuning
+        # and the Rabi frequency:
+        #   ψ(t_end) = exp(i n_D (φ - Δ t_end)) U(t_end - t_begin) exp(i n_D (Δ t_begin - φ)) ψ(t_begin)
+        # where n_D is the number of ions in D.
+        eigenvalues, eigenvectors = self.segment_eigensystem(detuning, rabi_frequency)
+        state = np.exp(1j * self.num_D * (detuning * t_begin - phase)) * state
+        state = eigenvectors @ (np.exp(-1j * eigenvalues * (t_end - t_begin)) * (eigenvectors.conj().T @ state))
+        return np.exp(1j * self.num_D * (phase - detuning * t_end)) * state
+
+    def segment_eigensystem(self, detuning, rabi_frequency):
+        key = (detuning, rabi_frequency)
+        if key in self.segments:
+            self.segments.move_to_end(key)
+            return self.segments[key]
+
+        selected = np.abs(self.transition_frequencies - detuning) <= 2 * np.pi * rwa_cutoff
+        hamiltonian = np.diag(self.energies - detuning * self.num_D).astype(complex)
+        coupling = np.zeros((self.dimension, self.dimension), dtype=complex)
+        np.add.at(coupling, (self.rows[selected], self.cols[selected]), rabi_frequency * self.values[selected])
+        hamiltonian += coupling + coupling.conj().T
+        eigensystem = np.linalg.eigh(hamiltonian)
+
+        self.segments[key] = eigensystem
+        while len(self.segments) > max_cached_segments:
+            self.segments.popitem(last=False)
+        return eigensystem
+
+    def propagate_multiple_tones(self, state, tones, t_begin, t_end):
+        # Integrates the segment in the interaction picture with respect to
+        # the ion and mode energies, in which every remaining term rotates
+        # slower than rwa_cutoff.
+        rows, cols, values, frequencies = [], [], [], []
+        for detuning, (rabi_frequency, phase) in tones.items():
+            selected = np.abs(self.transition_frequencies - detuning) <= 2 * np.pi * rwa_cutoff
+            rows.append(self.rows[selected])
+            cols.append(self.cols[selected])
+            values.append(rabi_frequency * np.exp(1j * phase) * self.values[selected])
+            frequencies.append(self.transition_frequencies[selected] - detuning)
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        values = np.concatenate(values)
+        frequencies = np.concatenate(frequencies)
+
+        # Group the terms by the frequency at which they rotate
+        terms = []
+        for frequency in np.unique(frequencies):
+            selected = frequencies == frequency
+            matrix = scipy.sparse.csr_matrix((values[selected], (rows[selected], cols[selected])),
+                                             shape=(self.dimension, self.dimension))
+            terms.append((frequency, matrix, matrix.conj().T.tocsr()))
+
+        def derivative(t, interaction_state):
+            result = np.zeros(self.dimension, dtype=complex)
+            for frequency, matrix, adjoint in terms:
+                rotation = np.exp(1j * frequency * t)
+                result += rotation * (matrix @ interaction_state) + rotation.conjugate() * (adjoint @ interaction_state)
+            return -1j * result
+
+        interaction_state = np.exp(1j * self.energies * t_begin) * state
+        solution = scipy.integrate.solve_ivp(derivative, (t_begin, t_end), interaction_state,
+                                             method="DOP853", rtol=1e-8, atol=1e-10)
+        return np.exp(-1j * self.energies * t_end) * solution.y[:, -1]
+
+    def top_fock_state_population(self, state):
+        return (np.abs(state)**2).reshape(-1, self.fock_dimension)[:, -1].sum()
+
+    def measure(self, state):
+        #############################################
+        # Sum the populations of the S and D sublevels of each ion, in the
+        # order given by state_names
+        num_levels = len(self.simulated_levels)
+        populations = (np.abs(state)**2).reshape(-1, self.fock_dimension).sum(axis=-1)
+        if self.symmetric:
+            # the population with k ions in D is shared equally by the
+            # C(num_ions, k) readouts with k ions in D
+            num_D = self.occupations[:, self.is_D].sum(axis=1)
+            populations = np.bincount(num_D, weights=populations, minlength=self.num_ions + 1)
+            probabilities = np.array([populations[name.count("D")] / math.comb(self.num_ions, name.count("D"))
+                                      for name in state_names(self.num_ions)])
+        else:
+            populations = populations.reshape((num_levels,) * self.num_ions)
+            for ion in range(self.num_ions):
+                populations = np.stack([
+                    populations.take(np.flatnonzero(~self.is_D), axis=ion).sum(axis=ion),
+                    populations.take(np.flatnonzero(self.is_D), axis=ion).sum(axis=ion)], axis=ion)
+            probabilities = populations.ravel()
+
+        #############################################
+        # Apply projection noise and renormalize
+        probabilities = np.random.binomial(100, np.clip(probabilities, 0, 1)) / 100
+        return probabilities / probabilities.sum()
+
+def pulse_rabi_frequency(pulse):
+    # Rabi frequency of S-1/2 -> D-1/2 for this pulse, using the same pi time
+    # calibration as simulate.jl
+    intensity_factor = 10**(-0.5) # this corresponds to pi time 3 μs
+    pi_min = 3e-6
+    intensity = pulse["amp"] * 10**(-1.5 * pulse["att"] / 10)
+    if not intensity:
+        return 0.
+    t_pi = pi_min * math.sqrt(intensity_factor / intensity)
+    return np.pi / t_pi
@@ -0,0 +1,109 @@
+import numpy as np
+
+#
+# Append-only trace of DDS pulses, stored as one array per pulse property
+# plus an interned channel id per pulse, instead of one dict per pulse. The
+# arrays grow by doubling, so appending a pulse does not allocate (amortized),
+# and each column is available as a contiguous array.
+#
+# Indexing or iterating over a trace gives each pulse as a new dict with the
+# keys dds_name, time_on, time_off, freq, amp, att and phase, so that code
+# which expects a list of pulse dicts keeps working. Changing such a dict does
+# not change the trace.
+#
+pulse_columns = ("time_on", "time_off", "freq", "amp", "att", "phase")
+
+class PulseTrace:
+
+    def __init__(self, capacity=64):
+        self.channel_names = []
+        self.channel_ids = dict()
+        self.size = 0
+        self.channel_data = np.zeros(capacity, dtype=np.int32)
+        self.column_data = np.zeros((len(pulse_columns), capacity), dtype=float)
+
+    def channel_id(self, dds_name):
+        channel_id = self.channel_ids.get(dds_name)
+        if channel_id is None:
+            channel_id = self.channel_ids[dds_name] = len(self.channel_names)
+            self.channel_names.append(dds_name)
+        return channel_id
+
+    def append(self, dds_name, time_on, time_off, freq, amp, att, phase):
+        if self.size == len(self.channel_data):
+            self.reserve(self.size + 1)
+        self.channel_data[self.size] = self.channel_id(dds_name)
+        self.column_data[:, self.size] = (time_on, time_off, freq, amp, att, phase)
+        self.size += 1
+
+    def extend(self, dds_names, time_on, time_off, freq, amp, att, phase):
+        # Appends several pulses, given as a list of DDS names and one array
+        # of values per column
+        count = len(dds_names)
+        self.reserve(self.size + count)
+        self.channel_data[self.size:self.size + count] = [self.channel_id(dds_name) for dds_name in dds_names]
+        self.column_data[:, self.size:self.size + count] = (time_on, time_off, freq, amp, att, phase)
+        self.size += count
+
+    def reserve(self, capacity):
+        if capacity > len(self.channel_data):
+            capacity = max(capacity, 2 * len(self.channel_data))
+            channel_data = np.zeros(capacity, dtype=np.int32)
+            channel_data[:self.size] = self.channel_data[:self.size]
+            column_data = np.zeros((len(pulse_columns), capacity), dtype=float)
+            column_data[:, :self.size] = self.column_data[:, :self.size]
+            self.channel_data, self.column_data = channel_data, column_data
+
+    def channels(self):
+        # channel id of each pulse, i.e. the index of its DDS in channel_names
+        return self.channel_data[:self.size]
+
+    def column(self, name):
+        return self.column_data[pulse_columns.index(name), :self.size]
+
+    def columns(self):
+        return {name: self.column_data[i, :self.size] for i, name in enumerate(pulse_columns)}
+
+    def to_dicts(self):
+        channel_names = self.channel_names
+        return [dict(zip(("dds_name",) + pulse_columns, (channel_names[channel_id],) + values))
+            for channel_id, values in zip(self.channels().tolist(), zip(*self.column_data[:, :self.size].tolist()))]
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.to_dicts())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.size))]
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("pulse index out of range")
+        pulse = {"dds_name": self.channel_names[self.channel_data[index]]}
+        pulse.update(zip(pulse_columns, self.column_data[:, index].tolist()))
+        return pulse
+
+def concatenate_traces(traces):
+    # Concatenates the pulses of several traces into shared columns. Returns
+    # (point_offsets, channel_names, channels, columns), where the pulses of
+    # traces[i] are entries point_offsets[i] to point_offsets[i + 1] of
+    # channels and of each column, and channels holds indices into
+    # channel_names.
+    channel_ids = dict()
+    channel_names = []
+    channels = [np.zeros(0, dtype=np.int32)]
+    for trace in traces:
+        trace_channel_ids = []
+        for dds_name in trace.channel_names:
+            if dds_name not in channel_ids:
+                channel_ids[dds_name] = len(channel_names)
+                channel_names.append(dds_name)
+            trace_channel_ids.append(channel_ids[dds_name])
+        channels.append(np.array(trace_channel_ids, dtype=np.int32)[trace.channels()])
+    point_offsets = np.cumsum([0] + [len(trace) for trace in traces], dtype=np.int64)
+    columns = {name: np.concatenate([np.zeros(0)] + [trace.column(name) for trace in traces])
+        for name in pulse_columns}
+    return point_offsets, channel_names, np.concatenate(channels), columns
@@ -0,0 +1,59 @@
+import numpy as np
+
+#
+# Result files which are written incrementally, one scan point at a time, as a
+# standard .npy file holding a 1D array of records with one float64 field per
+# column (e.g. "x", "num_dark:1"). Each point is appended to the end of the
+# file, and the header is then rewritten with the new number of points, so
+# that a crash loses at most the point being written. The header is padded to
+# a fixed length which leaves room for any number of points.
+#
+# The files can be read back with read_results, or with
+# np.load(path, mmap_mode="r"), without loading them into memory.
+#
+class ResultWriter:
+
+    def __init__(self, path, column_names):
+        self.path = path
+        self.dtype = np.dtype([(name, "<f8") for name in column_names])
+        self.num_points = 0
+        self.header_length = len(self.header(10**18))
+        self.file = open(path, "wb")
+        self.write_header()
+
+    def header(self, num_points, header_length=0):
+        # magic string, version 1.0, header length and a header dictionary
+        # padded with spaces, so that the data starts at a multiple of 64 bytes
+        header = repr({
+            "descr": np.lib.format.dtype_to_descr(self.dtype),
+            "fortran_order": False,
+            "shape": (num_points,),
+        })
+        padding = max(header_length, -(-(10 + len(header) + 1) // 64) * 64) - (10 + len(header) + 1)
+        header = (header + " " * padding + "\n").encode("latin1")
+        return b"\x93NUMPY\x01\x00" + len(header).to_bytes(2, "little") + header
+
+    def write_header(self):
+        self.file.seek(0)
+        self.file.write(self.header(self.num_points, self.header_length))
+        self.file.seek(0, 2)
+
+    def append(self, values):
+        # values has one value per column, in the order of column_names
+        self.file.write(np.array(tuple(values), dtype=self.dtype).tobytes())
+        self.file.flush()
+        self.num_points += 1
+        self.write_header()
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def read_results(path):
+    # Returns the results as a memory-mapped array of records, e.g.
+    # read_results(path)["num_dark:1"]
+    try:
+        return np.load(path, mmap_mode="r")
+    except ValueError:
+        # a file without any points cannot be memory-mapped
+        return np.load(path)
@@ -0,0 +1,91 @@
+from sipyco.pc_rpc import Client
+import atexit
+import threading
+import time
+
+# Set to False (e.g. with disable_rpc_connections in worker processes) to
+# never connect to the logger, grapher or visualizer
+rpc_connections_enabled = True
+
+# Seconds to wait after a failed connection before trying to connect again
+rpc_retry_interval = 60.0
+
+def disable_rpc_connections():
+    global rpc_connections_enabled
+    rpc_connections_enabled = False
+
+#
+# Lazily connected sipyco RPC connection, shared by all pulse sequences in a
+# process. It connects on first use rather than when it is created, and after
+# a failed connection (or a call which failed with an OSError, see failed) it
+# does not try again for rpc_retry_interval seconds, so that runs without the
+# GUIs do not pay a connection timeout per pulse sequence.
+#
+class RPCConnection:
+
+    def __init__(self, host, port, target_name):
+        self.host = host
+        self.port = port
+        self.target_name = target_name
+        self.rpc_client = None
+        self.failure_time = None
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def available(self):
+        # whether client() may return a connection, without connecting
+        if not rpc_connections_enabled:
+            return False
+        return (self.rpc_client is not None or self.failure_time is None or
+            time.monotonic() - self.failure_time >= rpc_retry_interval)
+
+    def client(self):
+        # returns the connected Client, or None if there is no connection
+        with self.lock:
+            if not self.available():
+                return None
+            if self.rpc_client is None:
+                try:
+                    self.rpc_client = Client(self.host, self.port, self.target_name)
+                    self.failure_time = None
+                except:
+                    self.failure_time = time.monotonic()
+            return self.rpc_client
+
+    def failed(self):
+        # drops the connection after a call failed, and waits for
+        # rpc_retry_interval before connecting again
+        self.close()
+        self.failure_time = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if self.rpc_client is not None:
+                try:
+                    self.rpc_client.close_rpc()
+                except:
+                    pass
+                self.rpc_client = None
+
+#
+# Logger which sends the messages to the remote simulation logger if it is
+# connected, and to a local logger otherwise
+#
+class RemoteLogger:
+
+    def __init__(self, connection, local_logger):
+        self.connection = connection
+        self.local_logger = local_logger
+
+    def __getattr__(self, name):
+        def log(*args, **kwargs):
+            client = self.connection.client()
+            if client is not None:
+                try:
+                    return getattr(client, name)(*args, **kwargs)
+                except OSError:
+                    self.connection.failed()
+                except:
+                    pass
+            return getattr(self.local_logger, name)(*args, **kwargs)
+        return log
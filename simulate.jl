@@ -3,12 +3,51 @@ using QuantumOptics
 using DifferentialEquations
 using Distributions
 using DataStructures
+using PyCall
 
-export simulate_with_ion_sim
+export simulate_with_ion_sim, simulate_batch_with_ion_sim, simulate_batch_with_pulse_columns, last_point_timings
 
 # Note: IonSim seems to have problems with timescales other than 1e-6
 timescale = 1e-6
 
+S = ["S-1/2", "S+1/2"]
+D = ["D-5/2", "D-3/2", "D-1/2" ,"D+1/2", "D+3/2", "D+5/2"]
+
+# Terms in the Hamiltonian which rotate faster than rwa_cutoff are dropped.
+#   Sublevels which are not coupled to the initial state by any 729G tone
+#   within pruning_threshold of resonance (or of a first-order motional
+#   sideband) are left out of the Hilbert space.
+rwa_cutoff = 1e5
+pruning_threshold = rwa_cutoff
+
+# The Fock cutoff (the highest phonon number simulated) of the axial mode is
+#   estimated from the pulses, and doubled until the population of the top
+#   Fock state is at most fock_tolerance, up to max_fock_cutoff.
+min_fock_cutoff = 2
+max_fock_cutoff = 40
+fock_tolerance = 1e-4
+
+# The simulation setups of recent calls are kept, so that consecutive calls
+#   with the same trap and lasers reuse the Hamiltonian.
+max_cached_setups = 8
+cached_setups = OrderedDict{Any, Any}()
+
+# The states at the pulse boundaries of earlier scan points are kept, keyed
+#   by the model (trap frequencies, number of ions, magnetic field, simulated
+#   sublevels and Fock cutoff) and by the 729G pulses up to that boundary,
+#   including their frequencies. They do not depend on the lasers which are
+#   only used after the boundary, so they are shared between setups with
+#   different 729G frequencies, e.g. by the points of a detuning scan.
+max_cached_prefix_states = 1024
+cached_prefix_states = OrderedDict{Any, Vector{ComplexF64}}()
+prefix_state_hits = 0
+
+# Wall time in seconds spent on each scan point of the last batch: one row
+#   per scan point, with the time spent on building the Hamiltonian, on the
+#   ODE solve and on the projection, in this order, followed by the Fock
+#   cutoff which was used for the point (see last_point_timings).
+point_timings = zeros(0, 4)
+
 function simulate_with_ion_sim(parameters, pulses, num_ions, b_field)
     #############################################
     # This function must return a dictionary of result values. The keys
@@ -21,17 +60,156 @@ function simulate_with_ion_sim(parameters, pulses, num_ions, b_field)
     #   --> for num_ions == 2: "SS", "SD", "DS", "DD"
     #           e.g., Dict("SS" => 0.1, "SD" => 0.2, "DS" => 0.3, "DD" => 0.4)
     #   --> for num_ions == 3: "SSS", "SSD", "SDS", "SDD", etc.
+    #   --> and so on for any number of ions
+    probabilities = simulate_batch_with_ion_sim(parameters, [pulses], num_ions, b_field)
+    result = Dict(name => probabilities[1, i] for (i, name) in enumerate(state_names(num_ions)))
+
+    #############################################
+    # Return the result
+    println("Simulation results: $result")
+    return result
+end
+
+function simulate_batch_with_ion_sim(parameters, pulses_per_point, num_ions, b_field)
+    #############################################
+    # Simulates all points of a scan at once. pulses_per_point contains one
+    #   list of pulses for each scan point.
+    # Returns a matrix with one row per scan point and one column per state,
+    #   with the states in the order given by state_names(num_ions), i.e.
+    #   "SS", "SD", "DS", "DD" for num_ions == 2.
+    # The ions, trap, lasers and Hamiltonian are built once for each group
+    #   of scan points which use the same set of 729G laser frequencies.
+    probabilities = zeros(length(pulses_per_point), 2^num_ions)
+    timings = zeros(length(pulses_per_point), 4)
+
+    groups = OrderedDict{Vector{Float64}, Vector{Int}}()
+    for (point_index, pulses) in enumerate(pulses_per_point)
+        frequencies = sort(unique([Float64(pulse["freq"]) for pulse in global_beam_pulses(pulses)]))
+        push!(get!(groups, frequencies, Int[]), point_index)
+    end
+
+    for (frequencies, point_indices) in groups
+        # If the pulses of every scan point are the pulses of the longest
+        #   scan point cut off at an earlier time (e.g. a duration scan),
+        #   a single solve up to the longest duration gives all of them.
+        longest_index = time_prefix_source(pulses_per_point, point_indices)
+        if longest_index !== nothing
+            println("Scan points are time prefixes of each other, simulating them in a single solve")
+            readout_times = [stop_time(pulses_per_point[point_index]) for point_index in point_indices]
+            setup, states, hamiltonian_time, solve_time = evolve_with_fock_cutoff(
+                parameters, frequencies, num_ions, b_field, pulses_per_point[longest_index], readout_times)
+            for (point_index, state) in zip(point_indices, states)
+                # the single solve is split evenly between the scan points
+                timings[point_index, 1] = hamiltonian_time / length(point_indices)
+                timings[point_index, 2] = solve_time / length(point_indices)
+                timings[point_index, 3] = @elapsed probabilities[point_index, :] = measure(setup, state)
+                timings[point_index, 4] = setup.mode.N
+                println("Scan point $point_index: Fock cutoff $(setup.mode.N)")
+            end
+        else
+            for point_index in point_indices
+                setup, states, hamiltonian_time, solve_time = evolve_with_fock_cutoff(
+                    parameters, frequencies, num_ions, b_field, pulses_per_point[point_index], Float64[])
+                timings[point_index, 1] = hamiltonian_time
+                timings[point_index, 2] = solve_time
+                timings[point_index, 3] = @elapsed probabilities[point_index, :] = measure(setup, states[end])
+                timings[point_index, 4] = setup.mode.N
+                println("Scan point $point_index: Fock cutoff $(setup.mode.N)")
+            end
+        end
+    end
+
+    global point_timings = timings
+    return probabilities
+end
+
+function last_point_timings()
+    # the point_timings of the last batch, for Python
+    return point_timings
+end
+
+struct Pulse
+    dds_name::String
+    time_on::Float64
+    time_off::Float64
+    freq::Float64
+    amp::Float64
+    att::Float64
+    phase::Float64
+end
+
+# so that a Pulse can be used in place of the pulse dictionaries passed from Python
+Base.getindex(pulse::Pulse, key::String) = getfield(pulse, Symbol(key))
+
+function simulate_batch_with_pulse_columns(parameters, point_offsets, channel_names, channels,
+                                           time_on, time_off, freq, amp, att, phase, num_ions, b_field)
+    #############################################
+    # Same as simulate_batch_with_ion_sim, with the pulses of all scan points
+    #   given as columns instead of dictionaries: the pulses of scan point i
+    #   are entries point_offsets[i] + 1 to point_offsets[i + 1] of channels
+    #   and of each column, and channels holds the 0-based index of the DDS
+    #   name of each pulse in channel_names.
+    pulses_per_point = [[Pulse(channel_names[channels[j] + 1], time_on[j], time_off[j], freq[j], amp[j], att[j], phase[j])
+                         for j in point_offsets[i] + 1:point_offsets[i + 1]]
+                        for i in 1:length(point_offsets) - 1]
+    return simulate_batch_with_ion_sim(parameters, pulses_per_point, num_ions, b_field)
+end
+
+function simulate_batch_with_numpy_columns(parameters, point_offsets, channel_names, channels,
+                                           time_on, time_off, freq, amp, att, phase, num_ions, b_field)
+    # wraps the NumPy arrays as Julia arrays without copying them
+    return simulate_batch_with_pulse_columns(parameters, PyArray(point_offsets), channel_names, PyArray(channels),
+        PyArray(time_on), PyArray(time_off), PyArray(freq), PyArray(amp), PyArray(att), PyArray(phase),
+        num_ions, b_field)
+end
+
+# Entry point for Python, which is passed the columns as NumPy arrays. Unlike
+#   the Julia functions called directly from Python, its arguments are not
+#   converted to Julia types by copying.
+simulate_batch_with_pulse_columns_from_python = pyfunction(simulate_batch_with_numpy_columns,
+    Dict{String,Any}, PyObject, Vector{String}, PyObject,
+    PyObject, PyObject, PyObject, PyObject, PyObject, PyObject, Int, Float64)
+
+function state_names(num_ions)
+    # "S" or "D" for each ion, with the first ion as the leftmost character,
+    # in the order "SS", "SD", "DS", "DD"
+    return [join(reverse(state)) for state in Iterators.product(fill(('S', 'D'), num_ions)...)][:]
+end
+
+function global_beam_pulses(pulses)
+    # TODO: Add 729L1 and 729L2
+    return [pulse for pulse in pulses if occursin("729G", pulse["dds_name"])]
+end
+
+function get_setup(parameters, frequencies, num_ions, b_field, fock_cutoff)
+    # Returns the cached simulation setup for these trap frequencies, lasers,
+    #   number of ions, magnetic field and Fock cutoff, or sets up a new one.
+    trap_frequencies = sort([(name, Float64(value)) for (name, value) in parameters if startswith(name, "TrapFrequencies.")])
+    key = (trap_frequencies, frequencies, num_ions, Float64(b_field), fock_cutoff)
+    if haskey(cached_setups, key)
+        return cached_setups[key]
+    end
+    setup = setup_simulation(parameters, frequencies, num_ions, b_field, fock_cutoff)
+    cached_setups[key] = setup
+    while length(cached_setups) > max_cached_setups
+        delete!(cached_setups, first(keys(cached_setups)))
+    end
+    return setup
+end
 
+function setup_simulation(parameters, frequencies, num_ions, b_field, fock_cutoff)
     #############################################
-    # Create and load the ions
-    S = ["S-1/2", "S+1/2"]
-    D = ["D-5/2", "D-3/2", "D-1/2" ,"D+1/2", "D+3/2", "D+5/2"]
+    # Create and load the ions, with only the sublevels which the lasers address
+    axial_frequency = parameters["TrapFrequencies.axial_frequency"]
+    levels = addressed_sublevels(frequencies, b_field, axial_frequency)
     ions = Array{Ca40}(undef, num_ions)
     for i = 1:num_ions
-        ions[i] = Ca40([S; D])
+        ions[i] = Ca40(levels)
     end
-    
-    axial_frequency = parameters["TrapFrequencies.axial_frequency"]
+
+    # used to calibrate the E-field on S-1/2 -> D-1/2, whether or not those are simulated
+    reference_ion = Ca40([S; D])
+
     radial_frequency_1 = parameters["TrapFrequencies.radial_frequency_1"]
     radial_frequency_2 = parameters["TrapFrequencies.radial_frequency_2"]
     chain = LinearChain(
@@ -40,39 +218,258 @@ function simulate_with_ion_sim(parameters, pulses, num_ions, b_field)
         vibrational_modes=(;z=[1]))
 
     #############################################
-    # Set up the lasers and the trap
-    laser_pulses = Dict()
-    for pulse_index in 1:length(pulses)
-        pulse = pulses[pulse_index]
-        if occursin("729G", pulse["dds_name"])
-            laser = Laser(
-                k=(x̂ + ẑ)/√2,
-                ϵ=(x̂ - ẑ)/√2,
-                Δ=pulse["freq"],
-            )
-            laser_pulses[laser] = pulse
-        end
-        # TODO: Add 729L1 and 729L2
-    end
-
-    lasers = Array{Laser}(undef, length(laser_pulses))
-    for (i, (laser, pulse)) in enumerate(laser_pulses)
-        lasers[i] = laser
+    # Set up the lasers and the trap, one laser per 729G frequency
+    lasers = Array{Laser}(undef, length(frequencies))
+    for (i, frequency) in enumerate(frequencies)
+        lasers[i] = Laser(
+            k=(x̂ + ẑ)/√2,
+            ϵ=(x̂ - ẑ)/√2,
+            Δ=frequency,
+        )
     end
 
-    trap = Trap(configuration=chain, B=b_field*1e-4, Bhat=ẑ, δB=0, lasers=lasers)
+    trap = Trap(configuration=chain, B=b_field*1e-4, Bhat=ẑ, δB=0, lasers=lasers)
     mode = trap.configuration.vibrational_modes.z[1]
+    mode.N = fock_cutoff
 
     for laser in lasers
         global_beam!(trap, laser)
     end
-    
+
+    #############################################
+    # Set up the time-dependent E-field and phase. The (time_on, time_off,
+    # E-field, phase) windows of each laser are filled in for every scan
+    # point, so that the same Hamiltonian can be reused for all of them.
+    laser_windows = [NTuple{4,Float64}[] for laser in lasers]
+    for (i, laser) in enumerate(lasers)
+        laser.E = t -> pulse_field(laser_windows[i], t)
+        laser.ϕ = t -> pulse_phase(laser_windows[i], t)
+    end
+
+    h = hamiltonian(trap, lamb_dicke_order=1, timescale=timescale, rwa_cutoff=rwa_cutoff)
+
+    # everything except the lasers which determines the state at a given time
+    trap_frequencies = sort([(name, Float64(value)) for (name, value) in parameters if startswith(name, "TrapFrequencies.")])
+    model_key = (trap_frequencies, num_ions, Float64(b_field), levels, fock_cutoff)
+
+    dimension = length(levels)^num_ions * (mode.N + 1)
+    full_dimension = length([S; D])^num_ions * (mode.N + 1)
+    println("Simulating sublevels $levels, Hilbert space dimension $dimension (instead of $full_dimension)")
+
+    return (ions=ions, reference_ion=reference_ion, levels=levels, dimension=dimension,
+            trap=trap, mode=mode, lasers=lasers, frequencies=frequencies,
+            laser_windows=laser_windows, hamiltonian=h, model_key=model_key,
+            readout_index=readout_index(ions[1], levels, num_ions))
+end
+
+function addressed_sublevels(frequencies, b_field, axial_frequency)
+    #############################################
+    # Returns the sublevels which are connected to the initial state S-1/2
+    #   by transitions that one of the 729G tones drives within
+    #   pruning_threshold of resonance, in the order of [S; D]. D-1/2 is always
+    #   kept, so that each ion has at least one S and one D sublevel.
+    addressed(s, d) = any(drives_transition(frequency, s, d, b_field, axial_frequency, -1:1) for frequency in frequencies)
+
+    kept = Set(["S-1/2", "D-1/2"])
+    changed = true
+    while changed
+        changed = false
+        for s in S, d in D
+            if (s in kept) != (d in kept) && addressed(s, d)
+                push!(kept, s, d)
+                changed = true
+            end
+        end
+    end
+    return [level for level in [S; D] if level in kept]
+end
+
+function drives_transition(frequency, s, d, b_field, axial_frequency, orders)
+    # Whether a tone drives the transition from sublevel s to sublevel d
+    #   within pruning_threshold of resonance, on any of the given orders of
+    #   motional sidebands (0 for the carrier)
+    bohr_magneton = 1.39962449361e10 # Hz/T
+    zeeman_shift(level) = (level in S ? 2.0 : 1.2) * sublevel_m(level) * bohr_magneton * b_field * 1e-4
+    transition_frequency = zeeman_shift(d) - zeeman_shift(s)
+    return quadrupole_coupling(sublevel_m(s), sublevel_m(d)) > 1e-9 &&
+        any(abs(frequency - transition_frequency - order * axial_frequency) <= pruning_threshold for order in orders)
+end
+
+function estimate_fock_cutoff(parameters, pulses, num_ions, b_field)
+    #############################################
+    # Estimates the number of phonons which the pulses can create, starting
+    #   from the motional ground state: each pulse which drives a first-order
+    #   sideband adds about one phonon per sideband π-pulse.
+    axial_frequency = parameters["TrapFrequencies.axial_frequency"]
+    sideband_pulse_area = 0.0
+    for pulse in global_beam_pulses(pulses)
+        if any(drives_transition(pulse["freq"], s, d, b_field, axial_frequency, (-1, 1)) for s in S, d in D)
+            rabi_frequency = π / pi_time(pulse)
+            duration = pulse["time_off"] - pulse["time_on"]
+            sideband_pulse_area += lamb_dicke_parameter(axial_frequency, num_ions) * rabi_frequency * duration / π
+        end
+    end
+    return clamp(min_fock_cutoff + ceil(Int, sideband_pulse_area), min_fock_cutoff, max_fock_cutoff)
+end
+
+function evolve_with_fock_cutoff(parameters, frequencies, num_ions, b_field, pulses, readout_times)
+    #############################################
+    # Evolves the pulses with the estimated Fock cutoff, and doubles the
+    #   cutoff until the population of the top Fock state is small enough.
+    #   Warns if it is still too large at max_fock_cutoff, in which case the
+    #   results are affected by the truncation of the mode. Returns the setup which was used, the states returned by evolve, and
+    #   the time spent on building the Hamiltonians and on solving.
+    fock_cutoff = estimate_fock_cutoff(parameters, pulses, num_ions, b_field)
+    hamiltonian_time = 0.0
+    solve_time = 0.0
+    while true
+        hamiltonian_time += @elapsed setup = get_setup(parameters, frequencies, num_ions, b_field, fock_cutoff)
+        solve_time += @elapsed states = evolve(setup, pulses, readout_times)
+        top_fock_population = maximum([top_fock_state_population(setup, state) for state in states])
+        if top_fock_population <= fock_tolerance
+            return setup, states, hamiltonian_time, solve_time
+        end
+        if fock_cutoff >= max_fock_cutoff
+            @warn "Population $top_fock_population in the top Fock state at the maximum Fock cutoff $max_fock_cutoff, the results are truncated"
+            return setup, states, hamiltonian_time, solve_time
+        end
+        fock_cutoff = min(2 * fock_cutoff, max_fock_cutoff)
+        println("Population $top_fock_population in the top Fock state, increasing the Fock cutoff to $fock_cutoff")
+    end
+end
+
+function top_fock_state_population(setup, state)
+    mode_state = ptrace(state, collect(1:length(setup.ions)))
+    return real(mode_state.data[end, end])
+end
+
+function lamb_dicke_parameter(axial_frequency, num_ions)
+    # of each ion for the axial COM mode, with the 729G beam at 45° to the axis
+    ħ = 1.054571817e-34
+    mass = 39.962591 * 1.66053906660e-27
+    k_z = 2π / 729.147e-9 / √2
+    return k_z * sqrt(ħ / (2 * mass * num_ions * 2π * axial_frequency))
+end
+
+function pi_time(pulse)
+    # S-1/2 -> D-1/2 π-time of a pulse, given its amplitude and attenuation
+    intensity_factor = 10^(-0.5) # this corresponds to pi time 3 μs
+    pi_min = 3e-6
+    return pi_min * sqrt(intensity_factor / (pulse["amp"] * 10^(-1.5 * pulse["att"] / 10)))
+end
+
+function sublevel_m(level)
+    # e.g. "D-5/2" -> -2.5
+    numerator, denominator = split(level[2:end], "/")
+    return parse(Int, numerator) / parse(Int, denominator)
+end
+
+function quadrupole_coupling(m_S, m_D)
+    # Geometric factor of the quadrupole coupling of the 729G beam
+    #   (k = (x̂ + ẑ)/√2, ϵ = (x̂ - ẑ)/√2, B along ẑ) for Δm = m_D - m_S
+    k = [1, 0, 1] / √2
+    ϵ = [1, 0, -1] / √2
+    T = (ϵ * k' + k * ϵ') / 2
+    components = Dict(
+        0 => (2 * T[3, 3] - T[1, 1] - T[2, 2]) / √6,
+        1 => -(T[1, 3] + im * T[2, 3]),
+        -1 => T[1, 3] - im * T[2, 3],
+        2 => (T[1, 1] - T[2, 2] + 2im * T[1, 2]) / 2,
+        -2 => (T[1, 1] - T[2, 2] - 2im * T[1, 2]) / 2,
+    )
+    q = round(Int, m_D - m_S)
+    return abs(q) <= 2 ? abs(components[q]) : 0.0
+end
+
+#############################################
+# Helpful functions
+function step_interval(t, t_begin, t_end)
+    t >= t_begin && t < t_end ? 1 : 0
+end
+
+function pulse_field(windows, t)
+    E = 0.0
+    for (t_begin, t_end, field, phase) in windows
+        E += field * step_interval(t, t_begin, t_end)
+    end
+    return E
+end
+
+function pulse_phase(windows, t)
+    for (t_begin, t_end, field, phase) in windows
+        if step_interval(t, t_begin, t_end) == 1
+            return phase
+        end
+    end
+    return 0.0
+end
+
+function time_prefix_source(pulses_per_point, point_indices)
+    # Returns the index of the scan point whose 729G pulses, cut off at the
+    #   end time of any other scan point, are exactly the 729G pulses of
+    #   that scan point. Returns nothing if there is no such scan point.
+    if length(point_indices) < 2
+        return nothing
+    end
+    longest_index = point_indices[argmax([stop_time(pulses_per_point[point_index]) for point_index in point_indices])]
+    longest_pulses = pulse_tuples(pulses_per_point[longest_index])
+    for point_index in point_indices
+        t_stop = stop_time(pulses_per_point[point_index])
+        clipped_pulses = sort([(pulse[1], min(pulse[2], t_stop), pulse[3:end]...)
+                               for pulse in longest_pulses if pulse[1] < t_stop])
+        if clipped_pulses != pulse_tuples(pulses_per_point[point_index])
+            return nothing
+        end
+    end
+    return longest_index
+end
+
+function pulse_tuples(pulses)
+    # (time_on, time_off, freq, amp, att, phase) of each 729G pulse which is
+    #   on for a finite time, in a canonical order, with times in units of
+    #   timescale
+    return sort([(pulse["time_on"] / timescale, pulse["time_off"] / timescale, Float64(pulse["freq"]),
+                  Float64(pulse["amp"]), Float64(pulse["att"]), Float64(pulse["phase"]))
+                 for pulse in global_beam_pulses(pulses) if pulse["time_off"] > pulse["time_on"]])
+end
+
+function prefix_key(pulse_tuples, t)
+    # the pulse tuples cut off at time t, which determine the state at time t
+    return (t, sort([(pulse[1], min(pulse[2], t), pulse[3:end]...) for pulse in pulse_tuples if pulse[1] < t]))
+end
+
+function stop_time(pulses)
+    # the time when the last 729G pulse is turned off, in units of timescale
+    pulses = global_beam_pulses(pulses)
+    return isempty(pulses) ? 0.0 : maximum([pulse["time_off"] / timescale for pulse in pulses])
+end
+
+function evolve(setup, pulses, readout_times)
+    #############################################
+    # Solves for the state after the given pulses. Returns the state at each
+    #   of the readout_times (in units of timescale), followed by the final
+    #   state.
+    trap = setup.trap
+    lasers = setup.lasers
+
+    #############################################
+    # Assign the pulses to the lasers
+    pulses = global_beam_pulses(pulses)
+    for (i, laser) in enumerate(lasers)
+        empty!(setup.laser_windows[i])
+        for pulse in pulses
+            if Float64(pulse["freq"]) == setup.frequencies[i]
+                E = Efield_from_pi_time(pi_time(pulse), trap.Bhat, laser, setup.reference_ion, ("S-1/2", "D-1/2"))
+                push!(setup.laser_windows[i], (pulse["time_on"] / timescale, pulse["time_off"] / timescale, E, 2π * pulse["phase"]))
+            end
+        end
+    end
+
     #############################################
     # Determine the simulation time when the relevant lasers are on
     simulation_start_time = Inf
     simulation_stop_time = 0
-    for laser in lasers
-        pulse = laser_pulses[laser]
+    for pulse in pulses
         simulation_start_time = min(simulation_start_time, pulse["time_on"] / timescale)
         simulation_stop_time = max(simulation_stop_time, pulse["time_off"] / timescale)
     end
@@ -81,109 +478,96 @@ function simulate_with_ion_sim(parameters, pulses, num_ions, b_field)
         simulation_stop_time = 0
     end
     simulation_total_time = simulation_stop_time - simulation_start_time
-    simulation_tspan = range(simulation_start_time - (1e-3*timescale), simulation_stop_time + (1e-3*timescale), length=2)
-    
+    simulation_end_time = simulation_stop_time + (1e-3*timescale)
+
     println("Total simulation time is $(simulation_total_time*timescale*1e6) μs")
     println("(start time = $(simulation_start_time*timescale*1e6) μs, stop time = $(simulation_stop_time*timescale*1e6) μs)")
 
     #############################################
-    # Helpful functions
-    function step_interval(t, t_begin, t_end)
-        t >= t_begin && t < t_end ? 1 : 0
-    end
-
-    function project(solution, states...)
-        real.(expect(ionprojector(trap, states...), solution))
-    end
+    # Resume from the latest cached state at a pulse boundary, if the pulses
+    #   up to that time are the same as for an earlier simulation
+    initial_state = ionstate(trap, fill("S-1/2", length(setup.ions))...)
+    resume_time = simulation_start_time - (1e-3*timescale)
+    resume_state = tensor(initial_state, fockstate(setup.mode, 0))
 
-    #############################################
-    # Set up the time-dependent E-field
-    intensity_factor = 10^(-0.5) # this corresponds to pi time 3 μs
-    pi_min = 3e-6
-    for laser in lasers
-        pulse = laser_pulses[laser]
-        t_pi = pi_min * sqrt(intensity_factor / (pulse["amp"] * 10^(-1.5 * pulse["att"] / 10)))
-        E = Efield_from_pi_time(t_pi, trap.Bhat, laser, ions[1], ("S-1/2", "D-1/2"))
-        laser.E = t -> E * step_interval(t, pulse["time_on"] / timescale, pulse["time_off"] / timescale)
+    tuples = pulse_tuples(pulses)
+    boundary_times = sort(unique([t for pulse in tuples for t in pulse[1:2]]))
+    latest_resume_time = minimum([readout_times; simulation_stop_time])
+    for t in reverse(boundary_times)
+        key = (setup.model_key, prefix_key(tuples, t))
+        if t > simulation_start_time && t <= latest_resume_time && haskey(cached_prefix_states, key)
+            # the cached amplitudes are in the same basis, which belongs to another setup
+            resume_time = t
+            resume_state = Ket(resume_state.basis, copy(cached_prefix_states[key]))
+            global prefix_state_hits += 1
+            println("Resuming from the cached state at $(resume_time*timescale*1e6) μs")
+            break
+        end
     end
+    boundary_times = [t for t in boundary_times if t > resume_time]
+    simulation_tspan = sort(unique([resume_time; readout_times; boundary_times; simulation_end_time]))
 
-    #############################################
-    # Set up the time-dependent phase
-    for laser in lasers
-        pulse = laser_pulses[laser]
-        laser.ϕ = t -> 2π * pulse["phase"]
-    end
-    
     #############################################
     # Run the simulation
-    initial_state = undef
-    if length(ions) == 1
-        initial_state = ionstate(trap, "S-1/2")
-    elseif length(ions) == 2
-        initial_state = ionstate(trap, "S-1/2", "S-1/2")
-    elseif length(ions) == 3
-        initial_state = ionstate(trap, "S-1/2", "S-1/2", "S-1/2")
-    end
-
     simulation_tstops = SortedSet{Float64}()
-    for laser in lasers
-        pulse = laser_pulses[laser]
+    for pulse in pulses
         push!(simulation_tstops, pulse["time_on"] / timescale)
         push!(simulation_tstops, pulse["time_off"] / timescale)
     end
-    simulation_tstops = collect(simulation_tstops)
+    for readout_time in readout_times
+        push!(simulation_tstops, readout_time)
+    end
+    simulation_tstops = [t for t in simulation_tstops if t > resume_time]
     println("Calculated pulse start/stop times as $simulation_tstops")
 
-    h = hamiltonian(trap, lamb_dicke_order=1, timescale=timescale, rwa_cutoff=1e5)
+    # the solution is saved at every time in simulation_tspan
     @time tout, solution = timeevolution.schroedinger_dynamic(
         simulation_tspan,
-        tensor(initial_state, fockstate(mode, 0)),
-        h,
+        resume_state,
+        setup.hamiltonian,
         callback=PresetTimeCallback(simulation_tstops, integrator -> return));
-    solution = solution[end]
-
-    #############################################
-    # Measure the expectation values
-    result = undef
-    if length(ions) == 1
-        result = Dict(
-            "S" => sum([project(solution, state) for state=S]),
-            "D" => sum([project(solution, state) for state=D]),
-            )
-    elseif length(ions) == 2
-        result = Dict(
-            "SS" => sum([project(solution, state1, state2) for state1=S, state2=S]),
-            "SD" => sum([project(solution, state1, state2) for state1=S, state2=D]),
-            "DS" => sum([project(solution, state1, state2) for state1=D, state2=S]),
-            "DD" => sum([project(solution, state1, state2) for state1=D, state2=D]),
-            )
-    elseif length(ions) == 3
-        result = Dict(
-            "SSS" => sum([project(solution, state1, state2, state3) for state1=S, state2=S, state3=S]),
-            "SSD" => sum([project(solution, state1, state2, state3) for state1=S, state2=S, state3=D]),
-            "SDS" => sum([project(solution, state1, state2, state3) for state1=S, state2=D, state3=S]),
-            "SDD" => sum([project(solution, state1, state2, state3) for state1=S, state2=D, state3=D]),
-            "DSS" => sum([project(solution, state1, state2, state3) for state1=D, state2=S, state3=S]),
-            "DSD" => sum([project(solution, state1, state2, state3) for state1=D, state2=S, state3=D]),
-            "DDS" => sum([project(solution, state1, state2, state3) for state1=D, state2=D, state3=S]),
-            "DDD" => sum([project(solution, state1, state2, state3) for state1=D, state2=D, state3=D]),
-            )
-    end
-    
-    #############################################
-    # Apply projection noise and renormalize
-    total_probability = 0
-    for (state, probability) in result
-        result[state] = mean(rand(Binomial(1, max(0, min(probability, 1))), 100))
-        total_probability += result[state]
+
+    states = Dict(zip(simulation_tspan, solution))
+    for t in boundary_times
+        cached_prefix_states[(setup.model_key, prefix_key(tuples, t))] = copy(states[t].data)
     end
-    for (state, probability) in result
-        result[state] = probability / total_probability
+    while length(cached_prefix_states) > max_cached_prefix_states
+        delete!(cached_prefix_states, first(keys(cached_prefix_states)))
     end
+    return [[states[readout_time] for readout_time in readout_times]; [solution[end]]]
+end
 
+function measure(setup, solution)
     #############################################
-    # Return the result
-    println("Simulation results: $result")
-    return result
+    # Sum the populations of all basis states in one pass over the state
+    #   vector: the ions come first in the tensor product and the first
+    #   subsystem varies fastest, so each column holds one Fock state.
+    populations = sum(reshape(abs2.(solution.data), :, setup.mode.N + 1), dims=2)
+    probabilities = zeros(length(state_names(length(setup.ions))))
+    for (ion_index, population) in enumerate(populations)
+        probabilities[setup.readout_index[ion_index]] += population
+    end
 
-end
\ No newline at end of file
+    #############################################
+    # Apply projection noise and renormalize
+    probabilities = [rand(Binomial(100, clamp(probability, 0, 1))) / 100 for probability in probabilities]
+    return probabilities / sum(probabilities)
+end
+
+function readout_index(ion, levels, num_ions)
+    #############################################
+    # For each basis state of the ions (without the mode), the index of its
+    #   S/D readout in state_names(num_ions), where the first ion is the
+    #   most significant
+    is_D = zeros(Bool, length(levels))
+    for level in levels
+        if level in D
+            is_D[argmax(abs.(ionstate(ion, level).data))] = true
+        end
+    end
+    index = zeros(Int, length(levels)^num_ions)
+    for (i, ion_levels) in enumerate(CartesianIndices(Tuple(fill(length(levels), num_ions))))
+        index[i] = 1 + sum(is_D[ion_levels[ion]] * 2^(num_ions - ion) for ion in 1:num_ions)
+    end
+    return index
+end
@@ -2,58 +2,187 @@ from artiq.language import core as core_language
 from sipyco.pc_rpc import Client
 from datetime import datetime
 from easydict import EasyDict as edict
+import hashlib
 import importlib
+import importlib.abc
 import importlib.machinery
 import importlib.util
+import itertools
 import json
 import logging
+import multiprocessing
 import numpy as np
 import os
+import time
 import traceback
 import sys
+from pulse_trace import PulseTrace, concatenate_traces, pulse_columns
+from result_file import ResultWriter
+from debug_trace import DebugTraceWriter
+from gui_sender import GuiSender
+from rpc_connection import RPCConnection, RemoteLogger, disable_rpc_connections
 
 logger = logging.getLogger(__name__)
 
 def unitless(param):
     return param
 
-global_julia_simulation_function = None
+global_julia_batch_simulation_function = None
+global_julia_columns_simulation_function = None
+global_julia_timings_function = None
+global_worker_pool = None
+global_worker_pool_size = 0
+global_worker_pool_backend = None
+global_simulation_server = None
+global_simulation_cache = None
+global_gui_sender = None
+
+# Connections to the remote logger and the GUIs, shared by all pulse sequences
+# in this process and connected on first use (see rpc_connection.py)
+global_logger_connection = RPCConnection("::1", 3289, "simulation_logger")
+global_grapher_connection = RPCConnection("::1", 3286, "rcg")
+global_visualizer_connection = RPCConnection("::1", 3289, "pulse_sequence_visualizer")
+
+# Folder under which each pulse sequence writes its output files, in a
+# <date>/<sequence name> subfolder, and the result cache keeps its files
+simulation_data_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "simulation")
+
+# Simulation backend used when run_simulation is not given one (see register_simulation_backend)
+default_simulation_backend = "ion_sim"
+
+# Address of the persistent simulation server (see simulation_server.py)
+simulation_server_host = "::1"
+simulation_server_port = 3290
+simulation_server_target = "ion_sim"
 
 #
-# Entry point to trigger a simulation of a particular experiment
+# Cache of transformed and compiled sequence sources, keyed by source path.
+# Each entry records the mtime and content hash of the source it was compiled
+# from, the compiled code object, and the module which was last executed from it.
 #
-def run_simulation(file_path, class_, argument_values, debug=False):
+global_import_cache = dict()
+
+def _import_cache_is_current(module_name, path):
+    entry = global_import_cache.get(path)
     try:
-        # define a function to import a modified source file
-        def modify_and_import(module_name, path, modification_func):
-            # adapted from https://stackoverflow.com/questions/41858147/how-to-modify-imported-source-code-on-the-fly
-            loader = importlib.machinery.SourceFileLoader(module_name, path)
-            source = loader.get_source(module_name)
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return False
+    return (entry is not None
+        and entry["module_name"] == module_name
+        and entry["mtime"] == mtime
+        and entry["module"] is not None
+        and sys.modules.get(module_name) is entry["module"])
+
+def _snapshot_class_state(module):
+    # add_subsequence overwrites class attributes with parameter values, so
+    # remember the original class attributes in order to restore them when
+    # the module is reused
+    return {value: dict(vars(value)) for value in module.__dict__.values()
+        if isinstance(value, type) and value.__module__ == module.__name__}
+
+def _restore_class_state(class_state):
+    for cls, attributes in class_state.items():
+        for name in list(vars(cls)):
+            if name not in attributes:
+                delattr(cls, name)
+        for name, value in attributes.items():
+            if vars(cls).get(name) is not value:
+                setattr(cls, name, value)
+
+def _exec_modified_source(module, path, modification_func):
+    # Executes a modified source file in the given module. The modified source
+    # is only compiled again when the file has changed.
+    # adapted from https://stackoverflow.com/questions/41858147/how-to-modify-imported-source-code-on-the-fly
+    module_name = module.__name__
+    mtime = os.stat(path).st_mtime_ns
+    entry = global_import_cache.get(path)
+    if entry is None or entry["module_name"] != module_name or entry["mtime"] != mtime:
+        with open(path, "rb") as source_file:
+            source = importlib.util.decode_source(source_file.read())
+        content_hash = hashlib.sha256(source.encode("utf-8")).hexdigest()
+        if entry is None or entry["module_name"] != module_name or entry["content_hash"] != content_hash:
             new_source = modification_func(source)
-            spec = importlib.util.spec_from_loader(loader.name, loader)
-            module = importlib.util.module_from_spec(spec)
-            codeobj = compile(new_source, module.__spec__.origin, 'exec')
-            exec(codeobj, module.__dict__)
-            sys.modules[module_name] = module
-            return module
-
-        # import all of the subsequences and strip out the @kernel decorators
-        subsequences_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sequences", "subsequences")
-        num_attempts = 2 # some may fail on first try due to dependencies, but will succeed eventually
-        for attempt in range(1, num_attempts+1):
-            for path, subdirs, files in os.walk(subsequences_folder):
-                for filename in files:
-                    filename_without_extension, extension = os.path.splitext(filename)
-                    if extension == ".py":
-                        try:
-                            module_name = "simulated_subsequences." + filename_without_extension
-                            experiment_file_full_path = os.path.join(path, filename)
-                            modify_and_import(module_name, experiment_file_full_path, lambda src:
-                                src.replace("@kernel", ""))
-                        except:
-                            if attempt == num_attempts:
-                                logger.error("Error importing subsequence " + filename_without_extension + ": " + traceback.format_exc())
-                            continue
+            entry = dict(
+                module_name=module_name,
+                content_hash=content_hash,
+                codeobj=compile(new_source, path, 'exec'))
+        entry["mtime"] = mtime
+        entry["module"] = None
+        global_import_cache[path] = entry
+
+    exec(entry["codeobj"], module.__dict__)
+    entry["module"] = module
+    entry["class_state"] = _snapshot_class_state(module)
+
+def modify_and_import(module_name, path, modification_func):
+    loader = importlib.machinery.SourceFileLoader(module_name, path)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    _exec_modified_source(module, path, modification_func)
+    sys.modules[module_name] = module
+    return module
+
+#
+# Import hook which loads simulated_subsequences.foo from sequences/subsequences/foo.py
+# (with the @kernel decorators stripped out) the first time it is imported, so
+# that only the subsequences an experiment actually uses are loaded, in the
+# order their imports require.
+#
+class SimulatedSubsequenceFinder(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    package_name = "simulated_subsequences"
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sequences", "subsequences")
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname == self.package_name:
+            spec = importlib.machinery.ModuleSpec(fullname, self, is_package=True)
+            spec.submodule_search_locations = [self.folder]
+            return spec
+        package_name, _, name = fullname.rpartition(".")
+        if package_name == self.package_name:
+            source_path = os.path.join(self.folder, name + ".py")
+            if os.path.exists(source_path):
+                spec = importlib.machinery.ModuleSpec(fullname, self, origin=source_path)
+                spec.has_location = True
+                return spec
+        return None
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        if module.__name__ == self.package_name:
+            return
+        _exec_modified_source(module, module.__spec__.origin, lambda src:
+            src.replace("@kernel", ""))
+
+    @classmethod
+    def refresh(cls):
+        # Reuses the subsequences loaded by a previous run if none of them have
+        # changed since. Otherwise they are all unloaded and imported again when
+        # needed, so that no module keeps a reference to an outdated class.
+        loaded_modules = [module for name, module in list(sys.modules.items())
+            if name.startswith(cls.package_name + ".")]
+        if all(_import_cache_is_current(module.__name__, module.__spec__.origin) for module in loaded_modules):
+            for module in loaded_modules:
+                _restore_class_state(global_import_cache[module.__spec__.origin]["class_state"])
+        else:
+            for module in loaded_modules:
+                del sys.modules[module.__name__]
+
+if not any(isinstance(finder, SimulatedSubsequenceFinder) for finder in sys.meta_path):
+    sys.meta_path.insert(0, SimulatedSubsequenceFinder())
+
+#
+# Entry point to trigger a simulation of a particular experiment. Returns the
+# results of each scan or, with return_timings, a tuple of the results and the
+# timings of each scan (see timing_phases).
+#
+def run_simulation(file_path, class_, argument_values, debug=False, num_workers=1, use_cache=False, batch=False,
+                   backend=None, return_timings=False):
+    try:
+        # subsequences are imported on demand by SimulatedSubsequenceFinder
+        SimulatedSubsequenceFinder.refresh()
 
         # import all of the auto calibration sequences and strip out the @kernel decorators
         auto_calibration_sequences_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "auto_calibration", "sequences")
@@ -75,6 +204,8 @@ def run_simulation(file_path, class_, argument_values, debug=False):
                         continue
 
         # load the experiment source and make the necessary modifications
+        # (the module is always executed again, since defining the experiment
+        # class sets PulseSequence.scan_params)
         file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), file_path)
         mod = modify_and_import(class_, file_path, lambda src: 
             src.replace("from pulse_sequence", "from simulated_pulse_sequence")
@@ -86,9 +217,15 @@ def run_simulation(file_path, class_, argument_values, debug=False):
         # execute the simulated pulse sequence
         pulse_sequence = getattr(mod, class_)()
         pulse_sequence.set_debug(debug)
+        pulse_sequence.set_num_workers(num_workers)
+        pulse_sequence.set_use_cache(use_cache)
+        pulse_sequence.set_batch(batch)
+        pulse_sequence.set_backend(backend or default_simulation_backend)
         pulse_sequence.set_submission_arguments(argument_values)
         pulse_sequence.simulate()
 
+        if return_timings:
+            return pulse_sequence.data, pulse_sequence.timings
         return pulse_sequence.data
     except:
         logger.error("Error simulating pulse sequence" + traceback.format_exc())
@@ -110,20 +247,388 @@ def initialize_julia():
         from julia import Main
         Main.include(path_to_simulate_jl)
 
-        global global_julia_simulation_function
-        global_julia_simulation_function = Main.simulate_with_ion_sim
+        global global_julia_batch_simulation_function
+        global global_julia_columns_simulation_function, global_julia_timings_function
+        global_julia_batch_simulation_function = Main.simulate_batch_with_ion_sim
+        global_julia_columns_simulation_function = Main.simulate_batch_with_pulse_columns_from_python
+        global_julia_timings_function = Main.last_point_timings
     except:
         print("Error loading Julia file simulate.jl: " + traceback.format_exc())
         raise
 
-    # Make a dummy call to the function to ensure everything is loaded
+    # Simulate a minimal scan point with both entry points, so that their code
+    # is compiled before the first real scan point
     try:
-        global_julia_simulation_function({}, {}, 1, 0)
+        parameters, pulses, num_ions, b_field = julia_warmup_arguments()
+        point_offsets, channel_names, channels, columns = concatenate_traces([pulses])
+        global_julia_columns_simulation_function(parameters, point_offsets, channel_names, channels,
+            *[columns[name] for name in pulse_columns], num_ions, b_field)
+        global_julia_batch_simulation_function(parameters, [pulses.to_dicts()], num_ions, b_field)
     except:
-        pass
+        logger.warning("Failed to warm up simulate.jl: " + traceback.format_exc())
 
     print("Successfully initialized Julia and IonSim.jl")
 
+def julia_warmup_arguments():
+    # One ion and a short carrier pulse on S-1/2 -> D-1/2, with the parameters
+    # which simulate.jl reads (the trap frequencies)
+    import sd_calculator
+    b_field = 4.
+    parameters = {
+        "TrapFrequencies.axial_frequency": 1e6,
+        "TrapFrequencies.radial_frequency_1": 2e6,
+        "TrapFrequencies.radial_frequency_2": 2.4e6,
+    }
+    frequency = dict(sd_calculator.get_sd_transition_energies(b_field, 0.))["S-1/2D-1/2"]
+    pulses = PulseTrace()
+    pulses.append("729G", 0., 1e-6, float(frequency), 1., 0., 0.)
+    return parameters, pulses, 1, b_field
+
+#
+# Names of the states returned by IonSim, e.g. "SS", "SD", "DS", "DD" for two
+# ions. This is also the order of the columns returned by simulate_batch_with_ion_sim.
+#
+def state_names(num_ions):
+    return ["".join(state) for state in itertools.product("SD", repeat=num_ions)]
+
+#
+# The simulation results are arrays of 2**num_ions state probabilities indexed
+# by bitmask: bit num_ions - 1 - i of the index is set when ion i is dark (D),
+# which is the order of state_names(num_ions).
+#
+global_dark_ions = dict()
+
+def dark_ions(num_ions):
+    # Matrix with one row per state and one column per ion, which is 1 where
+    # the ion is dark
+    if num_ions not in global_dark_ions:
+        states = np.arange(2**num_ions)
+        global_dark_ions[num_ions] = (states[:, None] >> (num_ions - 1 - np.arange(num_ions))[None, :]) & 1
+    return global_dark_ions[num_ions]
+
+#
+# Check for scans (e.g. duration scans) which IonSim can simulate in a single solve
+#
+def pulses_are_time_prefixes(pulses_per_point):
+    # True if the 729G pulses of every scan point are the 729G pulses of the
+    # longest scan point, cut off at the time when the last 729G pulse of that
+    # scan point ends, as in a duration scan. Like time_prefix_source in
+    # simulate.jl, only the 729G pulses are compared, since IonSim only
+    # simulates those (e.g. a readout pulse after the scanned pulse does not
+    # matter).
+    pulses_per_point = [[pulse for pulse in pulses if "729G" in pulse["dds_name"]] for pulses in pulses_per_point]
+
+    def stop_time(pulses):
+        return max([pulse["time_off"] for pulse in pulses], default=0.)
+
+    def pulse_tuple(pulse, time_off):
+        return (pulse["dds_name"], pulse["time_on"], time_off,
+                pulse["freq"], pulse["amp"], pulse["att"], pulse["phase"])
+
+    if len(pulses_per_point) < 2:
+        return False
+    longest_pulses = max(pulses_per_point, key=stop_time)
+    for pulses in pulses_per_point:
+        t_stop = stop_time(pulses)
+        clipped_pulses = sorted(pulse_tuple(pulse, min(pulse["time_off"], t_stop))
+            for pulse in longest_pulses if pulse["time_on"] < min(pulse["time_off"], t_stop))
+        point_pulses = sorted(pulse_tuple(pulse, pulse["time_off"])
+            for pulse in pulses if pulse["time_off"] > pulse["time_on"])
+        if clipped_pulses != point_pulses:
+            return False
+    return True
+
+#
+# Interval join of pulses, used to find the single-pass and double-pass pulses
+# which are on at the same time
+#
+def overlapping_pulses(time_on, time_off, first_indices, second_indices):
+    # Returns the pairs (i, j) of an index i from first_indices and an index j
+    # from second_indices for which pulses i and j, which are switched on and
+    # off at the given times, are both on for a finite time, by sweeping over
+    # their sorted switch-on and switch-off times. At equal times, pulses are
+    # switched off before others are switched on, so pulses which only touch
+    # do not overlap.
+    events = []
+    for group, indices in enumerate((first_indices, second_indices)):
+        for index in indices:
+            if time_on[index] < time_off[index]:
+                events.append((time_on[index], True, group, index))
+                events.append((time_off[index], False, group, index))
+    events.sort()
+
+    active = (set(), set())
+    pairs = []
+    for _, switched_on, group, index in events:
+        if switched_on:
+            for other_index in active[1 - group]:
+                pairs.append((index, other_index) if group == 0 else (other_index, index))
+            active[group].add(index)
+        else:
+            active[group].discard(index)
+    return pairs
+
+#
+# Pool of worker processes, each with its own initialized copy of Julia,
+# used to simulate the points of a scan in parallel
+#
+def get_worker_pool(num_workers, backend="ion_sim"):
+    global global_worker_pool, global_worker_pool_size, global_worker_pool_backend
+    if global_worker_pool is not None and global_worker_pool_size == num_workers and global_worker_pool_backend == backend:
+        return global_worker_pool
+    close_worker_pool()
+
+    # The workers are spawned rather than forked, since a forked copy of an
+    # already-initialized Julia runtime is not usable. Make sure the spawned
+    # workers can import this module even after os.chdir to the data folder.
+    repo_folder = os.path.dirname(os.path.abspath(__file__))
+    if repo_folder not in sys.path:
+        sys.path.insert(0, repo_folder)
+    context = multiprocessing.get_context("spawn")
+    global_worker_pool = context.Pool(num_workers, initializer=_initialize_worker, initargs=(backend,))
+    global_worker_pool_size = num_workers
+    global_worker_pool_backend = backend
+    return global_worker_pool
+
+def close_worker_pool():
+    global global_worker_pool, global_worker_pool_size, global_worker_pool_backend
+    if global_worker_pool is not None:
+        global_worker_pool.terminate()
+        global_worker_pool.join()
+    global_worker_pool = None
+    global_worker_pool_size = 0
+    global_worker_pool_backend = None
+
+#
+# Connection to the persistent simulation server, if one is running
+#
+def connect_simulation_server():
+    global global_simulation_server
+    if global_simulation_server is None:
+        try:
+            global_simulation_server = Client(simulation_server_host, simulation_server_port, simulation_server_target)
+        except:
+            global_simulation_server = None
+    return global_simulation_server
+
+def disconnect_simulation_server():
+    global global_simulation_server
+    if global_simulation_server is not None:
+        try:
+            global_simulation_server.close_rpc()
+        except:
+            pass
+    global_simulation_server = None
+
+#
+# Cache of IonSim results, shared by all pulse sequences in this process
+#
+def get_simulation_cache():
+    global global_simulation_cache
+    if global_simulation_cache is None:
+        from simulation_cache import SimulationCache
+        cache_folder = os.path.join(simulation_data_folder, "cache")
+        global_simulation_cache = SimulationCache(cache_folder)
+    return global_simulation_cache
+
+#
+# Background sender for the grapher and visualizer updates, shared by all
+# pulse sequences in this process (see gui_sender.py)
+#
+def get_gui_sender():
+    global global_gui_sender
+    if global_gui_sender is None:
+        global_gui_sender = GuiSender()
+    return global_gui_sender
+
+#
+# Phases of each scan point whose wall time is recorded in
+# PulseSequence.timings, in seconds:
+#   generation: running the pulse sequence, without combine
+#   combine: combine_laser_pulses
+#   simulation: the simulation by the backend, which is the sum of
+#       marshalling: everything except the following three phases, e.g.
+#           converting the pulses and the calls to Julia or the server
+#       hamiltonian: setting up the ions, lasers and Hamiltonian
+#       solve: the ODE solve (or the propagation)
+#       projection: computing the state probabilities with projection noise
+#   readout: record_scan_point, i.e. the state readout and plotting
+#   io: the result cache and the results file
+# The simulation phases are 0 for cached points, and the last four are NaN if
+# the backend does not report them. If several points are simulated in one
+# solve, its time is split evenly between them.
+# The records also hold the fock_cutoff which the backend chose for the point,
+# which is NaN for cached points and if the backend does not report it.
+#
+timing_phases = ("generation", "combine", "simulation", "marshalling", "hamiltonian", "solve", "projection",
+    "readout", "io")
+simulation_timing_fields = ("simulation", "marshalling", "hamiltonian", "solve", "projection", "fock_cutoff")
+timing_dtype = np.dtype([(field, "<f8") for field in timing_phases + ("fock_cutoff",)])
+
+def call_simulation_backend(backend, method_name, parameters, pulses, num_ions, b_field):
+    # Calls backend.simulate or backend.simulate_batch, and returns its result
+    # and an array of the simulation_timing_fields with one row per scan point.
+    num_points = len(pulses) if method_name == "simulate_batch" else 1
+    start_time = time.perf_counter()
+    result = getattr(backend, method_name)(parameters, pulses, num_ions, b_field)
+    total_time = time.perf_counter() - start_time
+    timings = np.full((num_points, len(simulation_timing_fields)), np.nan)
+    backend_timings = backend.last_timings()
+    if backend_timings is None or len(backend_timings) != num_points:
+        timings[:, 0] = total_time / num_points
+    else:
+        backend_timings = np.asarray(backend_timings, dtype=float).reshape(num_points, -1)
+        phase_timings = backend_timings[:, :3]
+        marshalling_time = (total_time - phase_timings.sum()) / num_points
+        timings[:, 0] = phase_timings.sum(axis=1) + marshalling_time
+        timings[:, 1] = marshalling_time
+        timings[:, 2:5] = phase_timings
+        if backend_timings.shape[1] > 3:
+            timings[:, 5] = backend_timings[:, 3]
+    return result, timings
+
+#
+# Simulation backends, selected per run with run_simulation(..., backend=name).
+# A backend simulates the laser pulses of one or more scan points and provides:
+#   initialize(in_worker): called in each process before the first simulation
+#   simulate(parameters, pulses, num_ions, b_field): returns an array of the
+#       state probabilities, indexed by bitmask (see dark_ions)
+#   simulate_batch(parameters, pulses_per_point, num_ions, b_field): returns a
+#       matrix with one such row per scan point
+#   model_fingerprint(): a string which changes whenever the model changes,
+#       e.g. a hash of its source and settings, which is part of the result
+#       cache key (see simulation_cache.py)
+#   last_timings(): the time spent on the hamiltonian, solve and projection
+#       phases (see timing_phases) of each point of the last call, as a matrix
+#       with one row per scan point, or None if they are not known. A fourth
+#       column, if present, is the Fock cutoff used for the point.
+# Other backends can be added with register_simulation_backend. The worker
+# processes look backends up by name, so a backend used with num_workers > 1
+# must be registered when its module is imported.
+#
+class SimulationBackend:
+    def initialize(self, in_worker=False):
+        pass
+
+    def simulate(self, parameters, pulses, num_ions, b_field):
+        raise NotImplementedError
+
+    def simulate_batch(self, parameters, pulses_per_point, num_ions, b_field):
+        results = [self.simulate(parameters, pulses, num_ions, b_field) for pulses in pulses_per_point]
+        return np.array(results, dtype=float).reshape(-1, 2**num_ions)
+
+    def model_fingerprint(self):
+        return type(self).__name__
+
+    def last_timings(self):
+        return None
+
+class IonSimBackend(SimulationBackend):
+    # IonSim.jl, on the simulation server if one is running, and in-process otherwise
+    def initialize(self, in_worker=False):
+        # the worker processes each simulate with their own copy of Julia
+        if (in_worker or not connect_simulation_server()) and not global_julia_batch_simulation_function:
+            initialize_julia()
+        self.point_timings = None
+
+    def simulate(self, parameters, pulses, num_ions, b_field):
+        # the Julia array is passed to Python without copying
+        return np.asarray(self.simulate_batch(parameters, [pulses], num_ions, b_field), dtype=float)[0]
+
+    def simulate_batch(self, parameters, pulses_per_point, num_ions, b_field):
+        if all(isinstance(pulses, PulseTrace) for pulses in pulses_per_point):
+            # The pulses of all points are passed as NumPy columns, which Julia
+            # wraps without copying or converting each pulse.
+            point_offsets, channel_names, channels, columns = concatenate_traces(pulses_per_point)
+            probabilities, self.point_timings = self.call_ion_sim("simulate_batch_with_pulse_columns", parameters,
+                point_offsets, channel_names, channels, *[columns[name] for name in pulse_columns],
+                int(num_ions), float(b_field))
+        else:
+            pulses_per_point = [list(pulses) for pulses in pulses_per_point]
+            probabilities, self.point_timings = self.call_ion_sim("simulate_batch_with_ion_sim", parameters,
+                pulses_per_point, num_ions, b_field)
+        return probabilities
+
+    def last_timings(self):
+        return self.point_timings
+
+    def model_fingerprint(self):
+        # the settings of the model (rwa_cutoff, pruning_threshold, the Fock
+        # cutoff settings, ...) are defined in simulate.jl itself
+        from simulation_cache import file_fingerprint
+        return file_fingerprint(os.path.join(os.path.dirname(os.path.abspath(__file__)), "simulate.jl"))
+
+    def call_ion_sim(self, function_name, *args):
+        # Calls the given IonSim batch entry point on the simulation server if
+        # one is connected, and in-process otherwise. Returns the probabilities
+        # and the timings of the scan points, which the server returns with
+        # the probabilities since it is shared by all clients.
+        if global_simulation_server:
+            try:
+                return getattr(global_simulation_server, function_name)(*args)
+            except OSError:
+                # The server went away, so continue with in-process Julia.
+                logger.warning("Lost connection to simulation server, falling back to in-process Julia")
+                disconnect_simulation_server()
+        if not global_julia_batch_simulation_function:
+            initialize_julia()
+        julia_functions = {
+            "simulate_batch_with_ion_sim": global_julia_batch_simulation_function,
+            "simulate_batch_with_pulse_columns": global_julia_columns_simulation_function,
+        }
+        probabilities = julia_functions[function_name](*args)
+        return probabilities, global_julia_timings_function()
+
+class NumpyBackend(SimulationBackend):
+    # NumPy/SciPy simulation with piecewise-constant propagators, which does
+    # not need Julia (see propagator_simulation.py)
+    def simulate(self, parameters, pulses, num_ions, b_field):
+        import propagator_simulation
+        return propagator_simulation.simulate_batch_with_propagators(parameters, [pulses], num_ions, b_field)[0]
+
+    def simulate_batch(self, parameters, pulses_per_point, num_ions, b_field):
+        import propagator_simulation
+        return propagator_simulation.simulate_batch_with_propagators(parameters, pulses_per_point, num_ions, b_field)
+
+    def last_timings(self):
+        import propagator_simulation
+        return propagator_simulation.last_point_timings
+
+    def model_fingerprint(self):
+        import propagator_simulation
+        from simulation_cache import file_fingerprint
+        settings = {name: getattr(propagator_simulation, name) for name in propagator_simulation.model_settings}
+        return file_fingerprint(propagator_simulation.__file__) + json.dumps(settings, sort_keys=True)
+
+simulation_backends = dict()
+
+def register_simulation_backend(name, backend):
+    simulation_backends[name] = backend
+
+def get_simulation_backend(name):
+    if name not in simulation_backends:
+        raise ValueError("Unknown simulation backend " + str(name) + ", available backends are " +
+            ", ".join(sorted(simulation_backends)))
+    return simulation_backends[name]
+
+register_simulation_backend("ion_sim", IonSimBackend())
+register_simulation_backend("numpy", NumpyBackend())
+
+def _initialize_worker(backend):
+    # A failure here must not propagate, otherwise the pool would keep
+    # respawning workers; it is reported when the worker simulates instead.
+    try:
+        disable_rpc_connections()
+        get_simulation_backend(backend).initialize(in_worker=True)
+    except:
+        pass
+
+def _simulate_in_worker(simulation_args):
+    backend, parameters, pulses, num_ions, b_field = simulation_args
+    result, timings = call_simulation_backend(get_simulation_backend(backend), "simulate",
+        parameters, pulses, num_ions, b_field)
+    return np.asarray(result, dtype=float), timings[0]
+
 class SimulatedDDSSwitch:
     def __init__(self, dds):
         self.dds = dds
@@ -206,9 +711,15 @@ class PulseSequence:
         self.simulated_pulses = None
         self.core = _FakeCore()
         self.data = edict()
+        self.timings = edict()
         self.scheduler = SimulationScheduler()
         self.rcg_tabs = dict()
         self.debug = False
+        self.num_workers = 1
+        self.use_cache = False
+        self.batch = False
+        self.backend = "ion_sim"
+        self.debug_trace = None
         
         self.grapher = None
         self.visualizer = None
@@ -220,14 +731,31 @@ class PulseSequence:
         self.rcg_tabs[self.sequence_name] = dict()
         self.start_time = datetime.now()
         self.timestamp = self.start_time.strftime("%H%M_%S")
-        self.dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "simulation",
-                                datetime.now().strftime("%Y-%m-%d"), self.sequence_name)
+        self.dir = os.path.join(simulation_data_folder, datetime.now().strftime("%Y-%m-%d"), self.sequence_name)
         os.makedirs(self.dir, exist_ok=True)
         os.chdir(self.dir)
 
     def set_debug(self, debug):
         self.debug = debug
 
+    def set_num_workers(self, num_workers):
+        # num_workers > 1 simulates the scan points in parallel on a pool of worker processes
+        self.num_workers = max(1, int(num_workers or 1))
+
+    def set_use_cache(self, use_cache):
+        # use_cache reuses IonSim results for identical pulses, ion number, B field and trap frequencies
+        self.use_cache = use_cache
+
+    def set_batch(self, batch):
+        # batch simulates all points of a scan with a single IonSim call
+        self.batch = batch
+
+    def set_backend(self, backend):
+        # backend is the name of a registered simulation backend, e.g. "ion_sim"
+        # to simulate with IonSim in Julia or "numpy" to simulate without Julia
+        get_simulation_backend(backend)
+        self.backend = backend
+
     def set_submission_arguments(self, submission_arguments):
         self.submission_arguments = submission_arguments
     
@@ -266,23 +794,12 @@ class PulseSequence:
             self.parameter_dict["Scan." + k] = v
 
         if self.debug:
-            # write all the parameters to a file
-            filename = self.timestamp + "_params_" + scan_name + ".txt"
-            with open(filename, "w") as param_file:
-                self.write_line(param_file, str(self.parameter_dict))
-            print("Parameters written to " + os.path.join(self.dir, filename))
+            # write all the parameters to the debug trace
+            self.debug_trace.write_parameters(scan_name, self.parameter_dict)
 
     def report_pulse(self, dds, time_switched_on, time_switched_off):
-        simulated_pulse = {
-            "dds_name": dds.name,
-            "time_on": time_switched_on,
-            "time_off": time_switched_off,
-            "freq": dds.freq,
-            "amp": dds.amplitude,
-            "att": dds.att,
-            "phase": dds.phase,
-        }
-        self.simulated_pulses.append(simulated_pulse)
+        self.simulated_pulses.append(dds.name, time_switched_on, time_switched_off,
+            dds.freq, dds.amplitude, dds.att, dds.phase)
 
     def combine_laser_pulses(self):
         # First, post-process the simulated_pulses to combine pulses that belong
@@ -297,42 +814,125 @@ class PulseSequence:
                     # phase: sum
                     # time_off: min
                     # time_on: max
-        self.combined_laser_pulses = []
-        for pulse in self.simulated_pulses:
-            if pulse["dds_name"].startswith("SP_"):
-                pulse["processed"] = True
-                for other_pulse in self.simulated_pulses:
-                    # pulse is a single-pass, e.g. SP_729G or SP_729G_bichro
-                    # looking for other_pulse to be the double-pass 729G
-                    laser_name = pulse["dds_name"][3:]
-                    if laser_name.startswith(other_pulse["dds_name"]):
-                        other_pulse["processed"] = True
-                        combined_time_on = max(pulse["time_on"], other_pulse["time_on"])
-                        combined_time_off = min(pulse["time_off"], other_pulse["time_off"])
-                        if combined_time_on < combined_time_off:
-                            new_pulse = {
-                                "dds_name": laser_name,
-                                "time_on": combined_time_on,
-                                "time_off": combined_time_off,
-                                "freq": pulse["freq"] + other_pulse["freq"] - 80e6,
-                                "amp": pulse["amp"] * other_pulse["amp"],
-                                "att": pulse["att"] + other_pulse["att"],
-                                "phase": pulse["phase"] + other_pulse["phase"],
-                            }
-                            self.combined_laser_pulses.append(new_pulse)
-
-        self.combined_laser_pulses.extend([pulse for pulse in self.simulated_pulses if "processed" not in pulse])
-
-    def simulate_with_ion_sim(self):
-        try:
-            return global_julia_simulation_function(
-                self.parameter_dict,
-                self.combined_laser_pulses,
-                self.num_ions,
-                self.current_b_field)
-        except:
-            self.logger.error("Error running IonSim simulation: " + traceback.format_exc())
-            raise
+
+        # The pulses are grouped by laser, and the overlapping pulses of each
+        # laser are found with an interval join. The combined pulses are
+        # created in the order of the single-pass pulses, and then of the
+        # double-pass pulses, in simulated_pulses, followed by the pulses
+        # which do not belong to a single-pass laser.
+        pulses = self.simulated_pulses
+        channel_names = pulses.channel_names
+        channels = pulses.channels()
+        time_on, time_off = pulses.column("time_on"), pulses.column("time_off")
+        processed = np.zeros(len(pulses), dtype=bool)
+        overlapping = []
+        for channel_id, dds_name in enumerate(channel_names):
+            if dds_name.startswith("SP_"):
+                # a single-pass, e.g. SP_729G or SP_729G_bichro
+                laser_name = dds_name[3:]
+                single_pass = channels == channel_id
+                # looking for the double-pass, e.g. 729G
+                double_pass = np.isin(channels, [other_id for other_id, other_name in enumerate(channel_names)
+                    if laser_name.startswith(other_name)])
+                processed |= single_pass | double_pass
+                overlapping.extend(overlapping_pulses(time_on.tolist(), time_off.tolist(),
+                    np.flatnonzero(single_pass).tolist(), np.flatnonzero(double_pass).tolist()))
+        overlapping = np.array(sorted(overlapping), dtype=int).reshape(-1, 2)
+        single_pass, double_pass = overlapping[:, 0], overlapping[:, 1]
+
+        columns = pulses.columns()
+        self.combined_laser_pulses = PulseTrace(len(overlapping) + len(pulses))
+        self.combined_laser_pulses.extend(
+            [channel_names[channel_id][3:] for channel_id in channels[single_pass].tolist()],
+            time_on=np.maximum(time_on[single_pass], time_on[double_pass]),
+            time_off=np.minimum(time_off[single_pass], time_off[double_pass]),
+            freq=columns["freq"][single_pass] + columns["freq"][double_pass] - 80e6,
+            amp=columns["amp"][single_pass] * columns["amp"][double_pass],
+            att=columns["att"][single_pass] + columns["att"][double_pass],
+            phase=columns["phase"][single_pass] + columns["phase"][double_pass])
+        unprocessed = ~processed
+        self.combined_laser_pulses.extend(
+            [channel_names[channel_id] for channel_id in channels[unprocessed].tolist()],
+            **{name: column[unprocessed] for name, column in columns.items()})
+
+    def simulation_cache_key(self, parameters, pulses):
+        from simulation_cache import SimulationCache
+        trap_frequencies = {name: value for name, value in parameters.items() if name.startswith("TrapFrequencies.")}
+        return SimulationCache.make_key(
+            pulses,
+            self.num_ions,
+            self.current_b_field,
+            trap_frequencies,
+            self.backend,
+            get_simulation_backend(self.backend).model_fingerprint())
+
+    def simulate_with_ion_sim(self, parameters=None, pulses=None):
+        # Simulates a single scan point, by default the most recently generated
+        # one. Returns the result and its simulation timings (see
+        # call_simulation_backend).
+        if parameters is None:
+            parameters = self.parameter_dict
+        if pulses is None:
+            pulses = self.combined_laser_pulses
+        if self.debug:
+            print("Calling IonSim with num_ions=" + str(self.num_ions) + ", " +
+                self.scan_parameter_name + "=" + str(parameters[self.scan_parameter_name]))
+        result, timings = call_simulation_backend(get_simulation_backend(self.backend), "simulate",
+            parameters, pulses, self.num_ions, self.current_b_field)
+        return result, timings[0]
+
+    def simulate_batch_with_ion_sim(self, simulation_args):
+        # Simulates several scan points, given as a list of (parameters, pulses,
+        # num_ions, b_field) tuples, with one IonSim call for each run of points
+        # with the same trap frequencies. Returns one result array and one row
+        # of simulation timings per point.
+        results = []
+        timings = []
+        trap_frequencies = lambda args: [(name, value) for name, value in sorted(args[0].items()) if name.startswith("TrapFrequencies.")]
+        for _, group in itertools.groupby(simulation_args, key=trap_frequencies):
+            group = list(group)
+            parameters, _, num_ions, b_field = group[-1]
+            probabilities, group_timings = call_simulation_backend(get_simulation_backend(self.backend),
+                "simulate_batch", parameters, [pulses for _, pulses, _, _ in group], num_ions, b_field)
+            results.extend(np.asarray(probabilities, dtype=float))
+            timings.extend(group_timings)
+        return list(zip(results, timings))
+
+    def simulate_scan_points(self, simulation_args, timings):
+        # Simulates the given scan points and yields the results in scan order,
+        # and records the simulation and cache timings of each point in the
+        # timings records.
+        # Points found in the result cache are not simulated again. The points
+        # are simulated on the worker pool if there is one, and otherwise with
+        # batched IonSim calls if requested or if they form a duration scan,
+        # which IonSim can then simulate in a single solve. Otherwise, each
+        # point is simulated separately.
+        cache_keys = []
+        cached_results = []
+        for point_index, args in enumerate(simulation_args):
+            start_time = time.perf_counter()
+            cache_keys.append(self.simulation_cache_key(args[0], args[1]) if self.use_cache else None)
+            cached_results.append(get_simulation_cache().get(cache_keys[-1]) if self.use_cache else None)
+            timings["io"][point_index] += time.perf_counter() - start_time
+        uncached_args = [args for args, cached_result in zip(simulation_args, cached_results) if cached_result is None]
+        if self.num_workers > 1:
+            results = get_worker_pool(self.num_workers, self.backend).imap(_simulate_in_worker,
+                [(self.backend,) + tuple(args) for args in uncached_args])
+        elif self.batch or pulses_are_time_prefixes([args[1] for args in uncached_args]):
+            results = iter(self.simulate_batch_with_ion_sim(uncached_args))
+        else:
+            results = (self.simulate_with_ion_sim(args[0], args[1]) for args in uncached_args)
+
+        for point_index, (cache_key, result_data) in enumerate(zip(cache_keys, cached_results)):
+            if result_data is None:
+                result_data, simulation_timings = next(results)
+                for field, value in zip(simulation_timing_fields, simulation_timings):
+                    timings[field][point_index] = value
+                if self.use_cache:
+                    start_time = time.perf_counter()
+                    get_simulation_cache().put(cache_key, result_data)
+                    timings["io"][point_index] += time.perf_counter() - start_time
+            yield result_data
 
     def simulate(self):
         self.load_parameters()
@@ -343,15 +943,23 @@ class PulseSequence:
 
         self.num_ions = int(self.p.IonsOnCamera.ion_number)
 
-        # Import the Julia simulation function
-        if not global_julia_simulation_function:
-            initialize_julia()
+        if self.use_cache:
+            get_simulation_cache().reset_counters()
+
+        # In debug mode, the parameters and pulses are written to a single
+        # trace log for the run (see debug_trace.py).
+        if self.debug:
+            self.debug_trace = DebugTraceWriter(self.timestamp + "_debug_trace.bin")
+
+        # Initialize the simulation backend (e.g. import the Julia simulation
+        # function), unless the scan points will be simulated by the worker
+        # processes instead.
+        if self.num_workers == 1:
+            get_simulation_backend(self.backend).initialize()
         
         run_initially_complete = False
         for scan_name in PulseSequence.scan_params:
             self.data[scan_name] = edict(x=[], y=[])
-            x_data = np.array([], dtype=float)
-            y_data = {}
             
             # Look up the settings for the current scan.
             scan_selection = scan_name + "-Scan_Selection"
@@ -375,83 +983,78 @@ class PulseSequence:
             if self.scan_settings["ty"] == "RangeScan":
                 scan_points = np.linspace(self.scan_settings["start"], self.scan_settings["stop"], self.scan_settings["npoints"])
 
-            # Iterate over the scan points and simulate one pulse sequence per point.
+            # Generate all of the pulse sequences up front, then simulate them
+            # and record the results in scan order.
+            # The time spent on each phase of each point is recorded in
+            # timings (see timing_phases).
+            timings = np.zeros(len(scan_points), dtype=timing_dtype)
+            timings["fock_cutoff"] = np.nan
+            x_values = []
+            simulation_args = []
             for scan_idx, scan_point in enumerate(scan_points):
-                # Reset the timer and stored pulse sequence.
-                self.setup_time_manager()
-                self.simulated_pulses = []
-
-                # Overwrite the scan parameter value with the current scan point.
-                setattr(self, variable_param_name, scan_point)
-                self.parameter_dict[self.scan_parameter_name] = scan_point
-
-                # Set the current x value for plotting. May be overwritten inside a pulse sequence.
-                self.current_x_value = scan_point
-
-                # Initialize the sequence by calling set_subsequence.
-                self.set_subsequence[scan_name]()
-
-                # Run the pulse sequence function to generate the pulse sequence.
-                current_sequence = getattr(self, scan_name)
-                current_sequence()
-
-                if self.debug:
-                    # Write the generated pulse sequences to a file.
-                    filename = self.timestamp + "_pulses_" + scan_name + "_" + str(scan_idx) + ".txt"
-                    with open(filename, "w") as pulses_file:
-                        self.write_line(pulses_file, json.dumps(self.simulated_pulses, sort_keys=True, indent=4))
-                    print("Pulse sequence written to " + os.path.join(self.dir, filename))
-
-                # Post-process the pulses to combine single-pass and double-pass pulses
-                # into laser pulses.
-                self.combine_laser_pulses()
-
-                if self.debug:
-                    # Write the generated laser pulses to a file.
-                    filename = self.timestamp + "_lasers_" + scan_name + "_" + str(scan_idx) + ".txt"
-                    with open(filename, "w") as lasers_file:
-                        self.write_line(lasers_file, json.dumps(self.combined_laser_pulses, sort_keys=True, indent=4))
-                    print("Laser sequence written to " + os.path.join(self.dir, filename))
-                
-                # Call IonSim code to simulate the dynamics.
-                if self.debug:
-                    print("Calling IonSim with num_ions=" + str(self.num_ions) + ", " + self.scan_parameter_name + "=" + str(scan_point))
-                result_data = self.simulate_with_ion_sim()
-                
-                # Guess the plot range.
-                range_offset = self.current_x_value - scan_point
-                range_guess = (scan_points[0] + range_offset, scan_points[-1] + range_offset)
-                
-                # Adjustment for absolute frequency scans, which should be displayed in MHz.
-                if self.sequence_name in self.frequency_scan_sequence_names:
-                    self.current_x_value = self.current_x_value * 1e-6
-                    range_guess = (range_guess[0] * 1e-6, range_guess[1] * 1e-6)
-
-                # Record and plot the result.
-                x_data = np.append(x_data, self.current_x_value)
-                self.perform_state_readout(result_data, y_data)
-                if self.grapher:
-                    for curve_name, curve_values in sorted(y_data.items()):
-                        plot_title = self.timestamp + " - " + scan_name + " - " + curve_name
-                        self.grapher.plot(x_data, curve_values,
-                            tab_name=PulseSequence.scan_params[scan_name][0][0],
-                            plot_title=plot_title, append=True,
-                            file_="", range_guess=range_guess)
+                start_time = time.perf_counter()
+                self.generate_pulse_sequence(scan_name, scan_idx, scan_point)
+                timings["combine"][scan_idx] = self.combine_time
+                timings["generation"][scan_idx] = time.perf_counter() - start_time - self.combine_time
+                x_values.append(self.current_x_value)
+                simulation_args.append((
+                    dict(self.parameter_dict),
+                    self.combined_laser_pulses,
+                    self.num_ions,
+                    self.current_b_field))
+
+            # The results are recorded into buffers preallocated for all of
+            # the scan points, which are filled up to num_recorded, and each
+            # point is appended to the binary results file as it completes.
+            x_data = np.zeros(len(scan_points), dtype=float)
+            y_data = {}
+            num_recorded = 0
+            result_writer = None
+            try:
+                results = self.simulate_scan_points(simulation_args, timings)
+                for scan_point, x_value, result_data in zip(scan_points, x_values, results):
+                    start_time = time.perf_counter()
+                    self.record_scan_point(scan_name, scan_points, scan_point, x_value,
+                        result_data, x_data, y_data, num_recorded)
+                    record_time = time.perf_counter()
+                    timings["readout"][num_recorded] = record_time - start_time
+                    if result_writer is None:
+                        result_writer = ResultWriter(self.timestamp + "_results_" + scan_name + ".npy",
+                            ["x"] + list(y_data))
+                    result_writer.append([x_data[num_recorded]] +
+                        [curve_values[num_recorded] for curve_values in y_data.values()])
+                    timings["io"][num_recorded] += time.perf_counter() - record_time
+                    num_recorded += 1
+            except:
+                self.logger.error("Error running IonSim simulation: " + traceback.format_exc())
+                raise
+            finally:
+                if result_writer is not None:
+                    result_writer.close()
         
-            # Add the results to self.data and output to file.
-            self.data[scan_name]["x"] = x_data
+            # Add the results to self.data, as views of the buffers, and output to file.
+            self.data[scan_name]["x"] = x_data[:num_recorded]
             for y_name, y_data in y_data.items():
-                self.data[scan_name]["y"].append(y_data)
+                self.data[scan_name]["y"].append(y_data[:num_recorded])
             filename = self.timestamp + "_results_" + scan_name + ".txt"
             with open(filename, "w") as results_file:
                 self.write_line(results_file, str(self.data[scan_name]))
             print("Results written to " + os.path.join(self.dir, filename))
+
+            # Keep the timings of the recorded points next to the results, and
+            # export them in the same format as the binary results file.
+            self.timings[scan_name] = timings[:num_recorded]
+            filename = self.timestamp + "_timings_" + scan_name + ".npy"
+            np.save(os.path.join(self.dir, filename), self.timings[scan_name])
+            print("Timings written to " + os.path.join(self.dir, filename) + ": " + ", ".join(
+                phase + " " + "{:.3f}".format(np.nansum(self.timings[scan_name][phase])) + " s"
+                for phase in timing_phases))
             
             # Visualize the most recent pulse sequence.
-            if self.visualizer:
+            if self.visualizer.available():
                 try:
                     dds, ttl, channels = self.make_human_readable_pulses()
-                    self.visualizer.plot_simulated_pulses(dds, ttl, channels)
+                    get_gui_sender().plot_simulated_pulses(self.visualizer, dds, ttl, channels)
                 except:
                     self.logger.warning("Failed to plot pulse sequence visualization:" + traceback.format_exc(), exc_info=True)
             
@@ -467,40 +1070,101 @@ class PulseSequence:
         except FitError:
             self.logger.error("FitError encountered in run_finally", exc_info=True)
             raise
+
+        if self.debug_trace:
+            self.debug_trace.close()
+            print("Debug trace written to " + os.path.join(self.dir, self.debug_trace.path))
         
+        if self.use_cache:
+            cache = get_simulation_cache()
+            self.logger.info("IonSim result cache: " + str(cache.hits) + " hits, " + str(cache.misses) +
+                " misses (hit rate " + "{:.0%}".format(cache.hit_rate()) + ")")
+
         self.logger.info(self.sequence_name + " complete! Timestamp " + self.timestamp + ", output files saved to " + self.dir)
 
-        if self.grapher:
-            try:
-                self.grapher.close_rpc()
-            except:
-                pass
-        if self.visualizer:
-            try:
-                self.visualizer.close_rpc()
-            except:
-                pass
-        if self.logger:
-            try:
-                self.logger.close_rpc()
-            except:
-                pass
+        # Send the remaining grapher and visualizer updates. The connections
+        # stay open for the next pulse sequence.
+        if global_gui_sender:
+            get_gui_sender().flush()
+
+    def generate_pulse_sequence(self, scan_name, scan_idx, scan_point):
+        # Generates the pulse sequence for a single scan point and stores the
+        # resulting laser pulses in self.combined_laser_pulses.
+        variable_param_name = self.scan_parameter_name.replace(".", "_")
+
+        # Reset the timer and stored pulse sequence.
+        self.setup_time_manager()
+        self.simulated_pulses = PulseTrace()
 
-    def perform_state_readout(self, result_data, y_data):
-        # Takes the data points contained in result_data and appends them
-        # to the accumulated data stored in y_data, taking into account the
-        # setting of the StateReadout.readout_mode parameter. 
-        def ensure_curve_exists(y_data, curve_name):
+        # Overwrite the scan parameter value with the current scan point.
+        setattr(self, variable_param_name, scan_point)
+        self.parameter_dict[self.scan_parameter_name] = scan_point
+
+        # Set the current x value for plotting. May be overwritten inside a pulse sequence.
+        self.current_x_value = scan_point
+
+        # Initialize the sequence by calling set_subsequence.
+        self.set_subsequence[scan_name]()
+
+        # Run the pulse sequence function to generate the pulse sequence.
+        current_sequence = getattr(self, scan_name)
+        current_sequence()
+
+        if self.debug:
+            # Write the generated pulse sequences to the debug trace.
+            self.debug_trace.write_pulses(scan_name, scan_idx, "pulses", self.simulated_pulses)
+
+        # Post-process the pulses to combine single-pass and double-pass pulses
+        # into laser pulses.
+        start_time = time.perf_counter()
+        self.combine_laser_pulses()
+        self.combine_time = time.perf_counter() - start_time
+
+        if self.debug:
+            # Write the generated laser pulses to the debug trace.
+            self.debug_trace.write_pulses(scan_name, scan_idx, "laser_pulses", self.combined_laser_pulses)
+
+    def record_scan_point(self, scan_name, scan_points, scan_point, x_value, result_data, x_data, y_data, point_index):
+        # Records the simulation result for a single scan point at point_index
+        # of the preallocated x_data and y_data buffers, and plots it.
+
+        # Guess the plot range.
+        range_offset = x_value - scan_point
+        range_guess = (scan_points[0] + range_offset, scan_points[-1] + range_offset)
+        
+        # Adjustment for absolute frequency scans, which should be displayed in MHz.
+        if self.sequence_name in self.frequency_scan_sequence_names:
+            x_value = x_value * 1e-6
+            range_guess = (range_guess[0] * 1e-6, range_guess[1] * 1e-6)
+
+        # Record and plot the result.
+        x_data[point_index] = x_value
+        self.perform_state_readout(result_data, y_data, point_index, len(x_data))
+        if self.grapher.available():
+            for curve_name, curve_values in sorted(y_data.items()):
+                plot_title = self.timestamp + " - " + scan_name + " - " + curve_name
+                get_gui_sender().plot(self.grapher, [x_data[point_index]], [curve_values[point_index]],
+                    tab_name=PulseSequence.scan_params[scan_name][0][0],
+                    plot_title=plot_title, file_="", range_guess=range_guess)
+
+    def perform_state_readout(self, result_data, y_data, point_index, num_points):
+        # Takes the state probabilities contained in result_data and stores
+        # them at point_index of the curves in y_data, which hold num_points
+        # values each, taking into account the setting of the
+        # StateReadout.readout_mode parameter. 
+        def set_curve_value(y_data, curve_name, y_value):
             if not curve_name in y_data:
-                y_data[curve_name] = np.array([], dtype=float)
+                y_data[curve_name] = np.zeros(num_points, dtype=float)
+            y_data[curve_name][point_index] = y_value
+        probabilities = np.asarray(result_data, dtype=float)
+        dark = dark_ions(self.num_ions)
+        num_dark = dark.sum(axis=1)
         readout_mode = self.parameter_dict["StateReadout.readout_mode"]
         if readout_mode in ["pmt", "pmtMLE", "pmt_parity", "pmt_states"]:
             # Curves are named num_dark:1, num_dark:2, ..., num_dark:self.num_ions
+            y_values = np.bincount(num_dark, weights=probabilities, minlength=self.num_ions + 1)
             for num_dark in range(1, self.num_ions + 1):
-                curve_name = "num_dark:" + str(num_dark)
-                ensure_curve_exists(y_data, curve_name)
-                y_value = np.sum([result_value for result_name, result_value in result_data.items() if result_name.count('D') == num_dark])
-                y_data[curve_name] = np.append(y_data[curve_name], y_value)
+                set_curve_value(y_data, "num_dark:" + str(num_dark), y_values[num_dark])
             if readout_mode == "pmt_parity":
                 # TODO: Add parity curve (pmt_parity is not currently implemented)
                 pass
@@ -509,80 +1173,62 @@ class PulseSequence:
                 pass
         elif readout_mode in ["camera"]:
             # Curves are named dark_ion:0, dark_ion:1, ...
+            y_values = probabilities @ dark
             for ion_idx in range(self.num_ions):
-                curve_name = "dark_ion:" + str(ion_idx)
-                ensure_curve_exists(y_data, curve_name)
-                y_value = np.sum([result_value for result_name, result_value in result_data.items() if result_name[ion_idx] == 'D'])
-                y_data[curve_name] = np.append(y_data[curve_name], y_value)
+                set_curve_value(y_data, "dark_ion:" + str(ion_idx), y_values[ion_idx])
         elif readout_mode in ["camera_states", "camera_parity"]:
-            # Curves are named state:SS, state:SD, etc.
-            for result_name, result_value in result_data.items():
-                curve_name = "state:" + str(result_name)
-                ensure_curve_exists(y_data, curve_name)
-                y_data[curve_name] = np.append(y_data[curve_name], result_value)
+            # Curves are named state:SS, state:SD, etc., and are always created in
+            # the same order.
+            for result_name, y_value in zip(state_names(self.num_ions), probabilities):
+                set_curve_value(y_data, "state:" + str(result_name), y_value)
             if readout_mode == "camera_parity":
                 # Add parity curve
-                curve_name = "parity"
-                ensure_curve_exists(y_data, curve_name)
-                y_value = np.sum([y_value * (-1)**curve_name.count('D') for curve_name, y_value in result_data.items()])
-                y_data[curve_name] = np.append(y_data[curve_name], y_value)
+                set_curve_value(y_data, "parity", probabilities @ (1 - 2 * (num_dark % 2)))
 
     def make_human_readable_pulses(self):
         # Converts self.simulated_pulses into the "human readable" format expected
         # by the pulse sequence visualizer GUI.
         # Returns a tuple: (dds, ttl, channels)
-        times = set()
-        dds_names = set()
-        for simulated_pulse in self.simulated_pulses:
-            dds_names.add(simulated_pulse["dds_name"])
-            times.add(simulated_pulse["time_on"])
-            times.add(simulated_pulse["time_off"])
-        dds_names = sorted(dds_names)
-        times = sorted(times)
+        pulses = self.simulated_pulses
+        time_on, time_off = pulses.column("time_on").tolist(), pulses.column("time_off").tolist()
+        dds_names = sorted(pulses.channel_names)
+        times = sorted(set(time_on) | set(time_off))
         times = times + [times[-1]*1.01] + [times[-1]*1.02]
 
         raw_channels = [["AdvanceDDS", 0]] + [["unused" + str(i), i] for i in range(1, 32)]
         raw_ttl = [[time, [1] + [0] * 31] for time in times]
 
-        def freq_and_amp(dds_name, time):
-            freq = 0.0
-            amp = 0.0
-            for simulated_pulse in self.simulated_pulses:
-                if dds_name == simulated_pulse["dds_name"] and time > simulated_pulse["time_on"] and time <= simulated_pulse["time_off"]:
-                    freq = simulated_pulse["freq"] / 1e6
-                    amp = simulated_pulse["amp"] * (10 ** (-simulated_pulse["att"] / 20))
-                    break
-            return freq, amp
-
-        raw_dds = []
-        for time in times[:-1]:
-            for dds_name in dds_names:
-                freq, amp = freq_and_amp(dds_name, time)
-                raw_dds.append([dds_name, freq, amp])
+        # The frequency and amplitude of each DDS at each time are those of
+        # the pulse which is on at that time, i.e. time_on < time <= time_off.
+        # Each pulse is on for a contiguous range of the sorted times, which is
+        # found with searchsorted. The pulses are filled in in reverse order,
+        # so that where pulses on the same DDS overlap, the first one wins.
+        dds_times = np.array(times[:-1])
+        dds_rows = {dds_name: row for row, dds_name in enumerate(dds_names)}
+        pulse_rows = [dds_rows[pulses.channel_names[channel_id]] for channel_id in pulses.channels().tolist()]
+        first_time = np.searchsorted(dds_times, time_on, side="right")
+        last_time = np.searchsorted(dds_times, time_off, side="right")
+        pulse_freqs = [freq / 1e6 for freq in pulses.column("freq").tolist()]
+        pulse_amps = [amp * (10 ** (-att / 20)) for amp, att in zip(pulses.column("amp").tolist(), pulses.column("att").tolist())]
+        freqs = np.zeros((len(dds_times), len(dds_names)))
+        amps = np.zeros((len(dds_times), len(dds_names)))
+        for index in reversed(range(len(pulses))):
+            row = pulse_rows[index]
+            freqs[first_time[index]:last_time[index], row] = pulse_freqs[index]
+            amps[first_time[index]:last_time[index], row] = pulse_amps[index]
+
+        raw_dds = [[dds_name, freq, amp]
+            for freq_row, amp_row in zip(freqs.tolist(), amps.tolist())
+            for dds_name, freq, amp in zip(dds_names, freq_row, amp_row)]
 
         return raw_dds, raw_ttl, raw_channels
 
     def setup_rpc_connections(self):
-        try:
-            self.logger = Client("::1", 3289, "simulation_logger")
-        except:
-            self.logger = logging.getLogger("** SIMULATION **")
-            #self.logger.warning("Failed to connect to remote logger", exc_info=True)
-
-        if not self.grapher:
-            try:
-                self.grapher = Client("::1", 3286, "rcg")
-            except:
-                #self.logger.warning("Failed to connect to RCG grapher", exc_info=True)
-                self.grapher = None
-
-        if not self.visualizer:
-            try:
-                self.visualizer = Client("::1", 3289, "pulse_sequence_visualizer")
-                pass
-            except:
-                #self.logger.warning("Failed to connect to pulse sequence visualizer", exc_info=True)
-                self.visualizer = None
+        # The connections are shared, and only connected when they are first
+        # used (see rpc_connection.py).
+        self.logger = RemoteLogger(global_logger_connection, logging.getLogger("** SIMULATION **"))
+        self.grapher = global_grapher_connection
+        self.visualizer = global_visualizer_connection
 
     def setup_carriers(self):
         self.carrier_names = [
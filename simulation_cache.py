@@ -0,0 +1,139 @@
+from collections import OrderedDict
+import hashlib
+import json
+import numpy as np
+import os
+
+#
+# Content-addressed cache of IonSim results, with an in-memory LRU tier and a
+# size-bounded on-disk tier. Results are keyed by a canonical hash of exactly
+# the inputs which determine them: the combined laser pulses, the number of
+# ions, the magnetic field, the trap frequencies, the simulation backend and
+# a fingerprint of the backend's model (its source and settings, see
+# SimulationBackend.model_fingerprint), so that the results of a changed
+# model are not reused from the on-disk tier.
+#
+# The results are arrays of state probabilities indexed by bitmask, as returned
+# by the simulation backends. Note that a cached result includes the projection
+# noise which was sampled when it was first simulated.
+#
+global_file_fingerprints = dict()
+
+def file_fingerprint(path):
+    # SHA-256 of the contents of a file, recomputed when it is modified
+    modification_time = os.path.getmtime(path)
+    if global_file_fingerprints.get(path, (None,))[0] != modification_time:
+        with open(path, "rb") as source_file:
+            global_file_fingerprints[path] = (modification_time, hashlib.sha256(source_file.read()).hexdigest())
+    return global_file_fingerprints[path][1]
+
+class SimulationCache:
+
+    def __init__(self, folder, max_memory_entries=4096, max_disk_bytes=256 * 1024 * 1024):
+        self.folder = folder
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.folder, exist_ok=True)
+        self.disk_bytes = sum(os.path.getsize(path) for path in self._disk_paths())
+
+    @staticmethod
+    def make_key(pulses, num_ions, b_field, trap_frequencies, backend="ion_sim", model_fingerprint=""):
+        # The pulses are sorted so that the key does not depend on the order
+        # in which they were reported.
+        canonical_pulses = sorted(json.dumps(pulse, sort_keys=True, default=float) for pulse in pulses)
+        canonical_inputs = json.dumps({
+            "pulses": canonical_pulses,
+            "num_ions": int(num_ions),
+            "b_field": float(b_field),
+            "trap_frequencies": {name: float(value) for name, value in trap_frequencies.items()},
+            "backend": backend,
+            "model": model_fingerprint,
+        }, sort_keys=True)
+        return hashlib.sha256(canonical_inputs.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        result = self.memory.get(key)
+        if result is not None:
+            self.memory.move_to_end(key)
+        else:
+            result = self._read_from_disk(key)
+            if result is not None:
+                self._put_in_memory(key, result)
+
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result.copy()
+
+    def put(self, key, result):
+        result = np.array(result, dtype=float)
+        self._put_in_memory(key, result)
+        self._write_to_disk(key, result)
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def clear(self):
+        self.memory.clear()
+        for path in self._disk_paths():
+            os.remove(path)
+        self.disk_bytes = 0
+
+    def _put_in_memory(self, key, result):
+        self.memory[key] = result
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def _disk_path(self, key):
+        return os.path.join(self.folder, key + ".json")
+
+    def _disk_paths(self):
+        return [os.path.join(self.folder, filename) for filename in os.listdir(self.folder)
+                if filename.endswith(".json")]
+
+    def _read_from_disk(self, key):
+        path = self._disk_path(key)
+        try:
+            with open(path, "r") as cache_file:
+                result = json.load(cache_file)
+            # entries written as dictionaries of named states are not used
+            if not isinstance(result, list):
+                return None
+            # mark the entry as recently used, so it is evicted last
+            os.utime(path)
+            return np.array(result, dtype=float)
+        except (OSError, ValueError):
+            return None
+
+    def _write_to_disk(self, key, result):
+        path = self._disk_path(key)
+        if os.path.exists(path):
+            return
+        contents = json.dumps(result.tolist())
+        with open(path, "w") as cache_file:
+            cache_file.write(contents)
+        self.disk_bytes += os.path.getsize(path)
+        if self.disk_bytes > self.max_disk_bytes:
+            self._evict_from_disk()
+
+    def _evict_from_disk(self):
+        # remove the least recently used entries until the cache fits again
+        paths = sorted(self._disk_paths(), key=os.path.getmtime)
+        self.disk_bytes = sum(os.path.getsize(path) for path in paths)
+        for path in paths:
+            if self.disk_bytes <= self.max_disk_bytes:
+                break
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.disk_bytes -= size
@@ -0,0 +1,56 @@
+from sipyco.pc_rpc import simple_server_loop
+import argparse
+import numpy as np
+import simulated_pulse_sequence
+
+#
+# Long-lived local server which keeps Julia and IonSim.jl loaded, so that
+# the IonSim entry points are already compiled when a new Python process
+# (e.g. a notebook or a batch script) runs its first scan point.
+#
+# Start it with:
+#   python ./simulation_server.py
+#
+# PulseSequence.simulate connects to it automatically when it is running,
+# and falls back to in-process Julia when it is not.
+#
+# Each entry point returns the probabilities together with the timings of the
+# scan points (see last_point_timings in simulate.jl), which are read within
+# the same call, since the server is shared by all of its clients.
+#
+class SimulationServer:
+    def simulate_batch_with_ion_sim(self, parameters, pulses_per_point, num_ions, b_field):
+        probabilities = np.asarray(simulated_pulse_sequence.global_julia_batch_simulation_function(
+            parameters, pulses_per_point, num_ions, b_field), dtype=float)
+        return probabilities, self._last_point_timings()
+
+    def simulate_batch_with_pulse_columns(self, parameters, point_offsets, channel_names, channels,
+                                          time_on, time_off, freq, amp, att, phase, num_ions, b_field):
+        probabilities = np.asarray(simulated_pulse_sequence.global_julia_columns_simulation_function(
+            parameters, point_offsets, channel_names, channels,
+            time_on, time_off, freq, amp, att, phase, num_ions, b_field), dtype=float)
+        return probabilities, self._last_point_timings()
+
+    def _last_point_timings(self):
+        return np.asarray(simulated_pulse_sequence.global_julia_timings_function(), dtype=float)
+
+    def ping(self):
+        return True
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description="IonSim simulation server")
+    parser.add_argument("--bind", default=simulated_pulse_sequence.simulation_server_host,
+                        help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", default=simulated_pulse_sequence.simulation_server_port, type=int,
+                        help="TCP port to listen on (default: %(default)d)")
+    return parser
+
+def main():
+    args = get_argparser().parse_args()
+    simulated_pulse_sequence.initialize_julia()
+    print("Simulation server listening on " + args.bind + ":" + str(args.port))
+    simple_server_loop({simulated_pulse_sequence.simulation_server_target: SimulationServer()},
+                       args.bind, args.port)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import pytest
+from debug_trace import DebugTraceReader, DebugTraceWriter
+from pulse_trace import PulseTrace
+
+def make_pulses():
+    pulses = PulseTrace()
+    pulses.append("729G", 0., 1e-6, 2.2e8, 1., 5., 0.)
+    pulses.append("397", 1e-6, 2e-6, 8e7, 0.5, 10., 0.25)
+    return pulses
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "debug_trace.bin")
+    writer = DebugTraceWriter(path)
+    writer.write_parameters("RabiFlopping", {"RabiFlopping.duration": 1e-6})
+    for scan_idx in range(3):
+        writer.write_pulses("RabiFlopping", scan_idx, "pulses", make_pulses())
+    writer.write_pulses("RabiFlopping", 2, "laser_pulses", make_pulses())
+    writer.close()
+
+    trace = DebugTraceReader(path)
+    assert trace.scan_names() == ["RabiFlopping"]
+    assert trace.points("RabiFlopping") == [0, 1, 2]
+    assert trace.parameters("RabiFlopping") == {"RabiFlopping.duration": 1e-6}
+    assert trace.pulses("RabiFlopping", 1).to_dicts() == make_pulses().to_dicts()
+    assert trace.laser_pulses("RabiFlopping", 2).to_dicts() == make_pulses().to_dicts()
+
+def test_existing_log_is_not_appended_to(tmp_path):
+    path = str(tmp_path / "1234_56_debug_trace.bin")
+    writers = [DebugTraceWriter(path) for _ in range(3)]
+    assert [writer.path for writer in writers] == [path, path[:-4] + "_2.bin", path[:-4] + "_3.bin"]
+    for scan_idx, writer in enumerate(writers):
+        writer.write_parameters("scan " + str(scan_idx), {})
+        writer.close()
+    for scan_idx, writer in enumerate(writers):
+        assert DebugTraceReader(writer.path).scan_names() == ["scan " + str(scan_idx)]
+
+def test_write_error_is_raised_on_close(tmp_path):
+    path = str(tmp_path / "debug_trace.bin")
+    writer = DebugTraceWriter(path)
+    # JSON object keys must be strings
+    writer.write_parameters("RabiFlopping", {("RabiFlopping", "duration"): 1e-6})
+    writer.write_pulses("RabiFlopping", 0, "pulses", make_pulses())
+    with pytest.raises(RuntimeError, match="Failed to write 1 of the records"):
+        writer.close()
+    assert writer.file.closed
+    # the records after the failed one are still written
+    assert DebugTraceReader(path).points("RabiFlopping") == [0]
@@ -0,0 +1,90 @@
+import logging
+import threading
+from gui_sender import GuiSender
+
+class FakeClient:
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = []
+
+    def plot(self, x_values, y_values, **kwargs):
+        if self.error:
+            raise self.error
+        self.calls.append((list(x_values), list(y_values), kwargs["plot_title"]))
+
+class FakeConnection:
+    def __init__(self, client, target_name="rcg"):
+        self.rpc_client = client
+        self.target_name = target_name
+
+    def client(self):
+        if isinstance(self.rpc_client, Exception):
+            raise self.rpc_client
+        return self.rpc_client
+
+    def failed(self):
+        self.rpc_client = None
+
+def test_sender_survives_failing_clients(caplog):
+    caplog.set_level(logging.WARNING, logger="gui_sender")
+    sender = GuiSender()
+    failing_grapher = FakeConnection(FakeClient(ValueError("bad plot")))
+    broken_grapher = FakeConnection(RuntimeError("no client"))
+    disconnected_grapher = FakeConnection(FakeClient(ConnectionResetError()))
+    grapher = FakeConnection(FakeClient())
+    for connection in (failing_grapher, broken_grapher, disconnected_grapher):
+        sender.plot(connection, [0.], [1.], "tab", "plot")
+        assert sender.flush(timeout=5)
+    assert disconnected_grapher.rpc_client is None
+    assert "bad plot" in caplog.text and "no client" in caplog.text
+
+    sender.plot(grapher, [0.], [1.], "tab", "plot")
+    sender.plot(grapher, [1.], [0.], "tab", "plot")
+    assert sender.flush(timeout=5)
+    assert sender.thread.is_alive()
+    # the points may be sent in one or two calls
+    points = [point for x_values, y_values, _ in grapher.rpc_client.calls for point in zip(x_values, y_values)]
+    assert points == [(0., 1.), (1., 0.)]
+    assert sender.close(timeout=5)
+    assert not sender.thread.is_alive()
+
+def test_stopped_sender_does_not_block():
+    sender = GuiSender(max_queued_messages=1)
+    assert sender.close(timeout=5)
+    # updates after close are dropped instead of filling the queue
+    grapher = FakeConnection(FakeClient())
+    done = threading.Event()
+    def plot():
+        for x in range(3):
+            sender.plot(grapher, [x], [x], "tab", "plot")
+        done.set()
+    threading.Thread(target=plot, daemon=True).start()
+    assert done.wait(5)
+    assert not grapher.rpc_client.calls
+
+class BlockingClient(FakeClient):
+    def __init__(self):
+        FakeClient.__init__(self)
+        self.release = threading.Event()
+
+    def plot(self, x_values, y_values, **kwargs):
+        self.release.wait(5)
+        FakeClient.plot(self, x_values, y_values, **kwargs)
+
+def test_flush_times_out_and_returns_when_thread_is_dead():
+    sender = GuiSender()
+    grapher = FakeConnection(BlockingClient())
+    sender.plot(grapher, [0.], [1.], "tab", "plot")
+    assert not sender.flush(timeout=0.2)
+
+    # an update which is still pending when the thread has stopped
+    sender_thread = sender.thread
+    sender.thread = threading.Thread(target=lambda: None)
+    sender.thread.start()
+    sender.thread.join()
+    assert not sender.flush()
+
+    sender.thread = sender_thread
+    grapher.rpc_client.release.set()
+    assert sender.close(timeout=5)
+    assert grapher.rpc_client.calls == [([0.], [1.], "plot")]
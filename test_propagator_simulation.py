@@ -0,0 +1,72 @@
+import logging
+import numpy as np
+import propagator_simulation
+import simulated_pulse_sequence
+
+parameters = {"TrapFrequencies.axial_frequency": 1e6}
+b_field = 4.
+
+def pulse(time_on, time_off, sideband):
+    # carrier (sideband 0) or blue sideband (sideband 1) of S-1/2 -> D-1/2
+    shifts = propagator_simulation.zeeman_shifts(b_field)
+    frequency = (shifts[propagator_simulation.levels.index("D-1/2")] - shifts[0] +
+                 sideband * parameters["TrapFrequencies.axial_frequency"])
+    return {"dds_name": "729G", "time_on": time_on, "time_off": time_off, "freq": frequency, "amp": 1., "att": 0.,
+            "phase": 0.}
+
+def phonon_ladder(num_phonons):
+    # alternating blue sideband and carrier π-pulses (of roughly the π time of
+    # the first sideband transition), which add one phonon each
+    carrier_pi_time = np.pi / propagator_simulation.pulse_rabi_frequency(pulse(0., 0., 0))
+    sideband_pi_time = carrier_pi_time / propagator_simulation.lamb_dicke_parameter(
+        parameters["TrapFrequencies.axial_frequency"], 1)
+    pulses = []
+    t = 0.
+    for _ in range(num_phonons):
+        pulses.append(pulse(t, t + sideband_pi_time, 1))
+        pulses.append(pulse(t + sideband_pi_time, t + sideband_pi_time + carrier_pi_time, 0))
+        t += sideband_pi_time + carrier_pi_time
+    return pulses
+
+def test_truncated_fock_cutoff_is_reported(monkeypatch, caplog):
+    monkeypatch.setattr(propagator_simulation, "max_fock_cutoff", 2)
+    pulses = phonon_ladder(3)
+    with caplog.at_level(logging.WARNING, logger="propagator_simulation"):
+        _, timings = simulated_pulse_sequence.call_simulation_backend(
+            simulated_pulse_sequence.get_simulation_backend("numpy"), "simulate_batch", parameters, [pulses], 1, b_field)
+    assert "maximum Fock cutoff 2" in caplog.text
+    assert timings[0, simulated_pulse_sequence.simulation_timing_fields.index("fock_cutoff")] == 2
+
+def test_fock_cutoff_is_recorded_per_point(caplog):
+    pulses_per_point = [[], phonon_ladder(1)]
+    with caplog.at_level(logging.WARNING, logger="propagator_simulation"):
+        propagator_simulation.simulate_batch_with_propagators(parameters, pulses_per_point, 1, b_field)
+    assert not caplog.text
+    fock_cutoffs = propagator_simulation.last_point_timings[:, 3]
+    assert fock_cutoffs[0] == propagator_simulation.min_fock_cutoff
+    assert fock_cutoffs[1] > propagator_simulation.min_fock_cutoff
+
+def test_cached_segments_match_uncached_propagation(monkeypatch):
+    # a Ramsey sequence followed by sideband and carrier pulses, in which the
+    # carrier segments repeat with different durations, phases and amplitudes
+    pulses = [pulse(0., 1.5e-6, 0), pulse(3e-6, 4.5e-6, 0), pulse(4.5e-6, 2e-5, 1), pulse(2e-5, 2.3e-5, 0),
+              pulse(2.5e-5, 4e-5, 1), pulse(4e-5, 4.1e-5, 0)]
+    for index, phase in enumerate((0., 0.25, 0., 0.5, 0.125, 0.75)):
+        pulses[index]["phase"] = phase
+    pulses[-1]["amp"] = 0.5
+    axial_frequency = parameters["TrapFrequencies.axial_frequency"]
+    simulated_levels = propagator_simulation.addressed_levels(set(p["freq"] for p in pulses), axial_frequency, b_field)
+
+    def evolve():
+        model = propagator_simulation.PiecewiseModel(axial_frequency, 2, b_field, simulated_levels, 4)
+        return model, model.evolve(pulses)
+
+    cached_model, cached_state = evolve()
+    # three distinct segment Hamiltonians: the sideband and the carrier with
+    # two Rabi frequencies
+    assert len(cached_model.segments) == 3
+    monkeypatch.setattr(propagator_simulation, "max_cached_segments", 0)
+    uncached_model, uncached_state = evolve()
+    assert not uncached_model.segments
+    assert np.allclose(cached_state, uncached_state, atol=1e-12)
+    assert np.isclose(np.linalg.norm(cached_state), 1)
@@ -0,0 +1,45 @@
+import numpy as np
+from result_file import ResultWriter, read_results
+
+column_names = ["x", "num_dark:1"]
+points = [(0., 0.), (1e-6, 0.25), (2e-6, 0.5)]
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "results.npy")
+    writer = ResultWriter(path, column_names)
+    for point in points:
+        writer.append(point)
+    writer.close()
+    results = read_results(path)
+    assert results.dtype.names == tuple(column_names)
+    assert np.array_equal(results["x"], [x for x, _ in points])
+    assert np.array_equal(results["num_dark:1"], [num_dark for _, num_dark in points])
+
+def test_header_is_rewritten_after_each_point(tmp_path):
+    path = str(tmp_path / "results.npy")
+    writer = ResultWriter(path, column_names)
+    # readable before any point is written, while the writer is still open
+    assert read_results(path).shape == (0,)
+    for num_points, point in enumerate(points, 1):
+        writer.append(point)
+        results = read_results(path)
+        assert results.shape == (num_points,)
+        assert tuple(results[-1]) == point
+        with open(path, "rb") as results_file:
+            # the header keeps its length, so the data never moves
+            assert len(results_file.read()) == writer.header_length + num_points * writer.dtype.itemsize
+    writer.close()
+
+def test_partially_written_file(tmp_path):
+    path = str(tmp_path / "results.npy")
+    writer = ResultWriter(path, column_names)
+    for point in points[:2]:
+        writer.append(point)
+    # a crash while writing the third point leaves part of its record, and a
+    # header which still counts two points
+    writer.file.write(np.array(points[2], dtype=writer.dtype).tobytes()[:5])
+    writer.file.flush()
+    results = read_results(path)
+    assert results.shape == (2,)
+    assert [tuple(point) for point in results] == points[:2]
+    writer.close()
@@ -48,5 +48,55 @@ for duration in 0:2e-6:50e-6
     push!(sideband_results, result["D"])
 end
 
+println("Testing a batched carrier Rabi flop:")
+batch_pulses = [
+    [
+        Dict(
+            "amp" => 1.0,
+            "att" => 6.0,
+            "dds_name" => "729G",
+            "freq" => carrier_frequency,
+            "phase" => 0.0,
+            "time_off" => duration,
+            "time_on" => 0.0
+        ),
+    ]
+    for duration in 0:1e-6:20e-6
+]
+batch_results = simulate_batch_with_ion_sim(test_parameters, batch_pulses, num_ions, b_field)
+
+println("Testing that a detuning scan resumes from the cached state after its first pulse:")
+detuning_pulses = [
+    [
+        Dict(
+            "amp" => 1.0,
+            "att" => 6.0,
+            "dds_name" => "729G",
+            "freq" => carrier_frequency,
+            "phase" => 0.25,
+            "time_off" => 2e-6,
+            "time_on" => 0.0
+        ),
+        Dict(
+            "amp" => 1.0,
+            "att" => 6.0,
+            "dds_name" => "729G",
+            "freq" => carrier_frequency + detuning,
+            "phase" => 0.0,
+            "time_off" => 4e-6,
+            "time_on" => 2e-6
+        ),
+    ]
+    for detuning in 0:1e3:4e3
+]
+hits_before = prefix_state_hits
+detuning_results = simulate_batch_with_ion_sim(test_parameters, detuning_pulses, num_ions, b_field)
+# the first pulse (unlike the pulses above) has a phase of 0.25, so the first
+#   point starts from the initial state, and every later point resumes after
+#   the first pulse, even though it uses other 729G frequencies
+@assert prefix_state_hits - hits_before == length(detuning_pulses) - 1
+
 println("Carrier results: $carrier_results")
+println("Batched carrier results: $(batch_results[:, 2])")
+println("Batched timings (hamiltonian, solve, projection, Fock cutoff): $(last_point_timings())")
 println("Sideband results: $sideband_results")
@@ -1,51 +1,193 @@
+import numpy as np
+import pytest
 import simulated_parameter_vault
 import simulated_pulse_sequence
+import types
+from pulse_trace import PulseTrace
 
 #
-# Single-ion Rabi flopping
+# Tests of the NumPy backend, which run without Julia. Run them with
+#   python -m pytest
+# The IonSim examples at the bottom of this file run with
+#   python ./test_simulated_pulse_sequence.py
 #
-simulated_parameter_vault.set_parameter(["IonsOnCamera", "ion_number"], 1)
-simulated_parameter_vault.set_parameter(["StateReadout", "readout_mode"], "pmt")
-
-rabi_result = simulated_pulse_sequence.run_simulation(
-    "sequences/rabi_flopping.py",
-    "RabiFlopping",
-    {
-        "RabiFlopping-Scan_Selection": "RabiFlopping.duration",
-        "RabiFlopping:RabiFlopping.duration": {
-            "ty": "RangeScan",
-            "start": 0,
-            "stop": 20e-6,
-            "npoints": 20
+
+@pytest.fixture(autouse=True)
+def simulation_data_folder(tmp_path, monkeypatch):
+    # The pulse sequences write their output files and the result cache to a
+    # temporary folder, and change to it, rather than to data/simulation.
+    monkeypatch.setattr(simulated_pulse_sequence, "simulation_data_folder", str(tmp_path / "simulation"))
+    monkeypatch.setattr(simulated_pulse_sequence, "global_simulation_cache", None)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path / "simulation"
+
+def run_rabi_flopping(backend=None, npoints=20, stop=20e-6, **kwargs):
+    simulated_parameter_vault.set_parameter(["IonsOnCamera", "ion_number"], 1)
+    simulated_parameter_vault.set_parameter(["StateReadout", "readout_mode"], "pmt")
+    return simulated_pulse_sequence.run_simulation(
+        "sequences/rabi_flopping.py",
+        "RabiFlopping",
+        {
+            "RabiFlopping-Scan_Selection": "RabiFlopping.duration",
+            "RabiFlopping:RabiFlopping.duration": {
+                "ty": "RangeScan",
+                "start": 0,
+                "stop": stop,
+                "npoints": npoints
+            },
         },
-    },
-)
+        backend=backend,
+        **kwargs
+    )
 
-#
-# Two-ion MS gate
-#
-simulated_parameter_vault.set_parameter(["IonsOnCamera", "ion_number"], 2)
-simulated_parameter_vault.set_parameter(["StateReadout", "readout_mode"], "camera_states")
-
-ms_result = simulated_pulse_sequence.run_simulation(
-    "sequences/molmer_sorensen.py",
-    "MolmerSorensenGate",
-    {
-        "MolmerSorensen-Scan_Selection": "MolmerSorensen.duration",
-        "MolmerSorensen:MolmerSorensen.duration": {
-            "ty": "RangeScan",
-            "start": 0,
-            "stop": 100e-6,
-            "npoints": 20
+def run_molmer_sorensen(backend=None, npoints=20, stop=100e-6):
+    simulated_parameter_vault.set_parameter(["IonsOnCamera", "ion_number"], 2)
+    simulated_parameter_vault.set_parameter(["StateReadout", "readout_mode"], "camera_states")
+    return simulated_pulse_sequence.run_simulation(
+        "sequences/molmer_sorensen.py",
+        "MolmerSorensenGate",
+        {
+            "MolmerSorensen-Scan_Selection": "MolmerSorensen.duration",
+            "MolmerSorensen:MolmerSorensen.duration": {
+                "ty": "RangeScan",
+                "start": 0,
+                "stop": stop,
+                "npoints": npoints
+            },
         },
-    },
-)
+        backend=backend,
+    )
 
-#
-# Print results
-#
-print("*** Single-ion Rabi flopping results ***")
-print(rabi_result)
+def test_rabi_flopping_with_numpy_backend():
+    import propagator_simulation
+    np.random.seed(0)
+    result = run_rabi_flopping(backend="numpy", npoints=21, stop=4e-6)["RabiFlopping"]
+
+    # resonant carrier Rabi flopping from the motional ground state, with the
+    # pi time calibration of the sequence's 729G pulse (amplitude 1, no
+    # attenuation) and the Debye-Waller factor of the ground state
+    eta = propagator_simulation.lamb_dicke_parameter(
+        simulated_parameter_vault.get_parameter(["TrapFrequencies", "axial_frequency"]), 1)
+    rabi_frequency = propagator_simulation.pulse_rabi_frequency({"amp": 1., "att": 0.}) * np.exp(-eta**2 / 2)
+    expected = np.sin(rabi_frequency * result["x"] / 2)**2
+
+    # the projection noise of 100 shots has a standard deviation of at most 0.05
+    errors = np.abs(result["y"][0] - expected)
+    assert errors.max() < 0.15
+    assert errors.mean() < 0.05
+
+def test_timings_are_returned_and_written(simulation_data_folder):
+    data, timings = run_rabi_flopping(backend="numpy", npoints=5, stop=4e-6, return_timings=True)
+    timings = timings["RabiFlopping"]
+    assert len(timings) == len(data["RabiFlopping"]["x"]) == 5
+    assert np.all(timings["simulation"] > 0)
+    assert np.all(timings["fock_cutoff"] >= 2)
+    # under <date>/<sequence name> in the output folder
+    timings_files = list(simulation_data_folder.glob("*/*/*_timings_RabiFlopping.npy"))
+    assert len(timings_files) == 1
+    assert np.array_equal(np.load(str(timings_files[0])), timings)
+
+def test_molmer_sorensen_with_numpy_backend():
+    np.random.seed(0)
+    result = run_molmer_sorensen(backend="numpy", npoints=5)["MolmerSorensen"]
+    SS, SD, DS, DD = result["y"]
+    assert np.allclose(SS + SD + DS + DD, 1)
+    assert SS[0] == 1
+
+    # the MS interaction couples SS and DD, so the population of the even
+    # parity states dominates, and the two ions are equally excited
+    assert np.all(SS + DD > SD + DS)
+    assert np.all(np.abs(SD - DS) < 0.15)
+
+def test_time_prefixes_ignore_pulses_other_than_729G():
+    def pulse(dds_name, time_on, time_off):
+        return {"dds_name": dds_name, "time_on": time_on, "time_off": time_off,
+                "freq": 80e6, "amp": 1., "att": 0., "phase": 0.}
+    # a duration scan of a 729G pulse, followed by a readout pulse
+    pulses_per_point = [[pulse("729G", 0., duration), pulse("397", duration, duration + 1e-4)]
+        for duration in (1e-6, 2e-6, 3e-6)]
+    assert simulated_pulse_sequence.pulses_are_time_prefixes(pulses_per_point)
+    pulses_per_point[1][0]["phase"] = 0.5
+    assert not simulated_pulse_sequence.pulses_are_time_prefixes(pulses_per_point)
+
+def combine_laser_pulses_pairwise(pulses):
+    # the nested loop which combine_laser_pulses used before the interval
+    # join, on a list of pulse dicts
+    pulses = [dict(pulse) for pulse in pulses]
+    combined_laser_pulses = []
+    for pulse in pulses:
+        if pulse["dds_name"].startswith("SP_"):
+            pulse["processed"] = True
+            for other_pulse in pulses:
+                laser_name = pulse["dds_name"][3:]
+                if laser_name.startswith(other_pulse["dds_name"]):
+                    other_pulse["processed"] = True
+                    combined_time_on = max(pulse["time_on"], other_pulse["time_on"])
+                    combined_time_off = min(pulse["time_off"], other_pulse["time_off"])
+                    if combined_time_on < combined_time_off:
+                        combined_laser_pulses.append({
+                            "dds_name": laser_name,
+                            "time_on": combined_time_on,
+                            "time_off": combined_time_off,
+                            "freq": pulse["freq"] + other_pulse["freq"] - 80e6,
+                            "amp": pulse["amp"] * other_pulse["amp"],
+                            "att": pulse["att"] + other_pulse["att"],
+                            "phase": pulse["phase"] + other_pulse["phase"],
+                        })
+    combined_laser_pulses.extend([pulse for pulse in pulses if "processed" not in pulse])
+    return combined_laser_pulses
+
+def combine_laser_pulses(pulses):
+    sequence = types.SimpleNamespace(simulated_pulses=PulseTrace())
+    for pulse in pulses:
+        sequence.simulated_pulses.append(**pulse)
+    simulated_pulse_sequence.PulseSequence.combine_laser_pulses(sequence)
+    return sequence.combined_laser_pulses.to_dicts()
+
+def test_combine_laser_pulses_matches_pairwise_loop():
+    def pulse(dds_name, time_on, time_off, index):
+        return {"dds_name": dds_name, "time_on": time_on, "time_off": time_off, "freq": 80e6 + index * 1e3,
+                "amp": 0.5 + index / 100, "att": float(index), "phase": index / 10}
+    pulses = [
+        # overlapping
+        pulse("729G", 0., 2e-6, 0), pulse("SP_729G", 1e-6, 3e-6, 1),
+        # touching end-to-start, in both orders
+        pulse("SP_729G", 3e-6, 4e-6, 2), pulse("729G", 4e-6, 5e-6, 3), pulse("SP_729G", 5e-6, 6e-6, 4),
+        # nested, with a bichromatic single-pass of the same double-pass
+        pulse("729G", 1e-5, 2e-5, 5), pulse("SP_729G", 1.2e-5, 1.4e-5, 6), pulse("SP_729G_bichro", 1.1e-5, 1.9e-5, 7),
+        # another laser, a zero-length pulse, and channels without a single-pass
+        pulse("SP_854", 0., 1e-5, 8), pulse("854", 2e-6, 3e-6, 9), pulse("854", 5e-6, 5e-6, 10),
+        pulse("397", 0., 1e-5, 11), pulse("866", 1e-6, 2e-6, 12),
+    ]
+    assert combine_laser_pulses(pulses) == combine_laser_pulses_pairwise(pulses)
+
+    # random pulses on several channels, on a coarse time grid so that many
+    # pulses touch or start and stop together
+    rng = np.random.RandomState(0)
+    dds_names = ["729G", "SP_729G", "SP_729G_bichro", "854", "SP_854", "397"]
+    for _ in range(20):
+        pulses = []
+        for index in range(40):
+            time_on, time_off = sorted(rng.randint(0, 20, 2) * 1e-6)
+            pulses.append(pulse(dds_names[rng.randint(len(dds_names))], time_on, time_off, index))
+        assert combine_laser_pulses(pulses) == combine_laser_pulses_pairwise(pulses)
+
+if __name__ == "__main__":
+    #
+    # Single-ion Rabi flopping
+    #
+    rabi_result = run_rabi_flopping()
+
+    #
+    # Two-ion MS gate
+    #
+    ms_result = run_molmer_sorensen()
+
+    #
+    # Print results
+    #
+    print("*** Single-ion Rabi flopping results ***")
+    print(rabi_result)
 
-print("*** Two-ion MS gate results ***")
-print(ms_result)
+    print("*** Two-ion MS gate results ***")
+    print(ms_result)
@@ -0,0 +1,28 @@
+import numpy as np
+import os
+from simulation_cache import SimulationCache, file_fingerprint
+
+pulses = [{"dds_name": "729G", "time_on": 0., "time_off": 1e-5, "freq": 2.2e8, "amp": 1., "att": 5., "phase": 0.}]
+trap_frequencies = {"TrapFrequencies.axial_frequency": 1e6}
+
+def test_key_depends_on_model_fingerprint():
+    key = SimulationCache.make_key(pulses, 1, 4e-4, trap_frequencies, "numpy", "model a")
+    assert key == SimulationCache.make_key(pulses, 1, 4e-4, trap_frequencies, "numpy", "model a")
+    assert key != SimulationCache.make_key(pulses, 1, 4e-4, trap_frequencies, "numpy", "model b")
+
+def test_file_fingerprint_changes_with_file(tmp_path):
+    path = str(tmp_path / "model.jl")
+    with open(path, "w") as model_file:
+        model_file.write("rwa_cutoff = 1e5\n")
+    fingerprint = file_fingerprint(path)
+    with open(path, "w") as model_file:
+        model_file.write("rwa_cutoff = 1e6\n")
+    os.utime(path, (0, 1))
+    assert file_fingerprint(path) != fingerprint
+
+def test_disk_tier_round_trip(tmp_path):
+    key = SimulationCache.make_key(pulses, 1, 4e-4, trap_frequencies)
+    SimulationCache(str(tmp_path)).put(key, np.array([0.25, 0.75]))
+    cache = SimulationCache(str(tmp_path))
+    assert np.array_equal(cache.get(key), [0.25, 0.75])
+    assert cache.get(SimulationCache.make_key(pulses, 2, 4e-4, trap_frequencies)) is None